@@ -1,4 +1,18 @@
 import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
 
 symTable = {
     "SP": 0,
@@ -42,7 +56,17 @@ JTable = {
     "JLE": "110",
     "JMP": "111",
 }
-cnt = 0x000F
+VAR_BASE = 0x0010
+
+# part of every cache key; bump whenever the encoding of any program changes
+VERSION = "3"
+
+# every 8-bit half of a word, pre-rendered, so a word is emitted with two
+# lookups instead of a bin() call and a per-bit padding loop
+byteTable = [format(i, "08b") for i in range(256)]
+
+# full encoded word of every distinct C-instruction seen so far
+CCache = {}
 
 
 def isnumber(st):
@@ -53,9 +77,9 @@ def isnumber(st):
         return False
 
 
-def padding(x, l=16):
-    s = bin(int(x))[2:]
-    return "".join(["0" for i in range(l - len(s))]) + s
+def padding(x):
+    x = int(x)
+    return byteTable[x >> 8] + byteTable[x & 0xFF]
 
 
 def read_name(st):
@@ -65,28 +89,7 @@ def read_name(st):
     return st[:i]
 
 
-def readsym(name):
-    global cnt
-    if name in symTable.keys():
-        return symTable[name]
-    if len(name) > 1 and name[0] == "R" and isnumber(name[1:]):
-        return int(name[1:])
-    cnt += 1
-    symTable.setdefault(name, cnt)
-    return cnt
-
-
-def translate_A_command(st):
-    assert st[0] == "@"
-    st = st[1:]
-    if isnumber(st):
-        return padding(st)
-    else:
-        return padding(readsym(st))
-
-
-def translate_C_command(st):
-    global JTable, CTable
+def encode_C_command(st):
     i = st.find("=")
     j = st.find(";")
     if i == -1 and j == -1:
@@ -106,40 +109,34 @@ def translate_C_command(st):
         comp = st[i + 1 : j]
         jmp = st[j + 1 :]
 
-    D = ["0", "0", "0"]
+    D = 0
     if "A" in dest:
-        D[0] = "1"
+        D |= 4
     if "D" in dest:
-        D[1] = "1"
+        D |= 2
     if "M" in dest:
-        D[2] = "1"
+        D |= 1
 
     if "M" in comp:
-        A = "1"
+        A = 1
         comp = comp.replace("M", "A")
     else:
-        A = "0"
-    C = CTable[comp]
-    J = JTable[jmp]
-
-    return "111" + A + C + "".join(D) + J
+        A = 0
+    C = int(CTable[comp], 2)
+    J = int(JTable[jmp], 2)
 
+    return 0xE000 | A << 12 | C << 6 | D << 3 | J
 
-def new_line_marker(st, pc):
-    global symTable
-    if st[0] != "(" or st[-1] != ")":
-        raise SyntaxError("Missing brackets")
 
-    st = st[1:-1]
-    if st in symTable.keys():
-        print(st, pc)
-        raise SyntaxError("line marker have an ambiguous name")
-
-    symTable.setdefault(st, pc)
+def translate_C_command(st):
+    word = CCache.get(st)
+    if word is None:
+        word = CCache[st] = encode_C_command(st)
+    return word
 
 
 def modifyLine(line):
-    line = line[:-1]
+    line = line.rstrip("\n")
     i = line.find("//")
     if i != -1:
         line = line[:i]
@@ -147,40 +144,628 @@ def modifyLine(line):
     return line
 
 
+def strip_comments(lines):
+    # first stage of the pipeline: source lines in, bare instructions out,
+    # each with the (1-based) number of the line it came from
+    for lineno, line in enumerate(lines, 1):
+        line = modifyLine(line)
+        if line != "":
+            yield lineno, line
+
+
+def dest_of(st):
+    # destination field of a C-instruction
+    i = st.find("=")
+    return "" if i == -1 else st[:i]
+
+
+class Peephole:
+    """Optional pipeline stage between strip_comments and encoding. Rewrites
+    the instruction stream through a small window, never across a label:
+      M=M+1 / AM=M-1      -> A=M   (a push immediately popped again)
+      M=M+1 / M=M-1       -> gone
+      @X / @Y             -> @Y    (the first load is dead)
+      @X / C / @X         -> @X / C  when C does not write A
+      @L / ;Jxx / (L)     -> (L)   (a jump to the next instruction)
+    """
+
+    def __init__(self, window=8):
+        self.window = window
+        self.seen = 0
+        self.kept = 0
+
+    @property
+    def removed(self):
+        return self.seen - self.kept
+
+    def rewrite(self, out):
+        # apply one rule to the tail of the window, False if none matches
+        last = out[-1][1]
+        prev = out[-2][1] if len(out) > 1 else ""
+        head = last[0]
+        if head == "@" and prev[:1] == "@":
+            del out[-2]
+        elif head == "@" and len(out) > 2 and out[-3][1] == last:
+            if prev[0] == "(" or "A" in dest_of(prev):
+                return False
+            del out[-1]
+        elif prev == "M=M+1" and last == "AM=M-1":
+            out[-2:] = [(out[-2][0], "A=M")]
+        elif prev == "M=M+1" and last == "M=M-1":
+            del out[-2:]
+        elif head == "(" and len(out) > 2 and out[-3][1] == "@" + last[1:-1]:
+            if ";" not in prev or "=" in prev:
+                return False
+            del out[-3:-1]
+        else:
+            return False
+        return True
+
+    def run(self, lines):
+        # lines are (line number, instruction) pairs, as strip_comments makes
+        out = []
+        for item in lines:
+            if item[1][0] != "(":
+                self.seen += 1
+            out.append(item)
+            while out and self.rewrite(out):
+                pass
+            if len(out) > self.window:
+                item = out.pop(0)
+                if item[1][0] != "(":
+                    self.kept += 1
+                yield item
+        for item in out:
+            if item[1][0] != "(":
+                self.kept += 1
+            yield item
+
+
+class Assembler:
+    """Assembles hack programs; the symbol table and the variable allocator
+    belong to the instance, so any number of programs can be assembled in
+    one process, one after another or side by side."""
+
+    def __init__(self, optimize=False, listing=False):
+        self.optimize = optimize
+        # keep the source line of every instruction, for symbol maps
+        self.listing = listing
+        self.reset()
+
+    def reset(self):
+        self.symTable = dict(symTable)
+        self.cnt = VAR_BASE
+        self.variables = {}
+        self.lines = array("L")
+        self.peephole = Peephole()
+        # symbol -> ROM addresses of the A-instructions waiting for it
+        self.backpatch = {}
+        self.pc = 0
+
+    def readsym(self, name):
+        # address of an A-instruction symbol, or None if it is not bound yet
+        if name in self.symTable:
+            return self.symTable[name]
+        if len(name) > 1 and name[0] == "R" and isnumber(name[1:]):
+            return int(name[1:])
+        return None
+
+    def new_line_marker(self, st):
+        if st[0] != "(" or st[-1] != ")":
+            raise SyntaxError("Missing brackets")
+        st = st[1:-1]
+        if st in self.symTable:
+            print(st, self.pc)
+            raise SyntaxError("line marker have an ambiguous name")
+        self.symTable[st] = self.pc
+
+    def new_variable(self, name):
+        self.symTable[name] = self.variables[name] = self.cnt
+        self.cnt += 1
+        return self.symTable[name]
+
+    def encode(self, line):
+        # word of one instruction with comments stripped, None for a label;
+        # a symbol that is still unknown encodes as 0 until it is patched
+        head = line[0]
+        if head == "@":
+            st = line[1:]
+            word = self.symTable.get(st)
+            if word is None:
+                if st.isdigit() or isnumber(st):
+                    word = int(st)
+                else:
+                    word = self.readsym(st)
+                if word is None:
+                    where = self.backpatch.get(st)
+                    if where is None:
+                        where = self.backpatch[st] = array("L")
+                    where.append(self.pc)
+                    word = 0
+        elif head == "(":
+            self.new_line_marker(line)
+            return None
+        else:
+            word = translate_C_command(line)
+        self.pc += 1
+        return word
+
+    def stream(self, lines):
+        """Yield the words of a program as its lines come in. Only the symbol
+        table and the backpatch offsets are kept; the placeholders left for
+        forward references are listed by patches() once the stream ends."""
+        self.reset()
+        encode = self.encode
+        lines = strip_comments(lines)
+        if self.optimize:
+            lines = self.peephole.run(lines)
+        listing = self.lines.append if self.listing else None
+        for lineno, line in lines:
+            word = encode(line)
+            if word is not None:
+                if listing:
+                    listing(lineno)
+                yield word
+
+    def patches(self):
+        # whatever is still unbound after the scan is a variable; they are
+        # given RAM addresses in order of first reference
+        for st, where in self.backpatch.items():
+            address = self.symTable.get(st)
+            if address is None:
+                address = self.new_variable(st)
+            for i in where:
+                yield i, address
+        self.backpatch = {}
+
+    def assemble(self, lines):
+        # single scan: labels are bound as they are met, A-instructions whose
+        # symbol is still unknown get a placeholder and are patched at the end
+        words = array("H", self.stream(lines))
+        for i, address in self.patches():
+            words[i] = address
+        return words
+
+    def symbol_map(self):
+        """Labels, variables and the source line of every instruction, each
+        as a list sorted by address, for address-to-symbol lookups."""
+        labels = [
+            (address, name)
+            for name, address in self.symTable.items()
+            if name not in symTable and name not in self.variables
+        ]
+        variables = [(address, name) for name, address in self.variables.items()]
+        return {
+            "labels": sorted(labels),
+            "variables": sorted(variables),
+            "lines": list(enumerate(self.lines)),
+        }
+
+
+def assemble(lines):
+    return Assembler().assemble(lines)
+
+
+class SymbolMap:
+    """Address-to-symbol lookups over the index written by write_symbols:
+    binary searches over address-sorted lists."""
+
+    def __init__(self, index):
+        self.labels = [tuple(x) for x in index["labels"]]
+        self.variables = [tuple(x) for x in index["variables"]]
+        self.lines = [tuple(x) for x in index["lines"]]
+        self.labelAddress = [x[0] for x in self.labels]
+        self.variableAddress = [x[0] for x in self.variables]
+        self.lineAddress = [x[0] for x in self.lines]
+
+    @classmethod
+    def load(cls, fin):
+        with open(fin, "r") as f:
+            return cls(json.load(f))
+
+    def label_at(self, address):
+        # the label of the code an ROM address belongs to, i.e. the closest
+        # one at or before it
+        i = bisect_right(self.labelAddress, address)
+        return self.labels[i - 1][1] if i else None
+
+    def variable_at(self, address):
+        i = bisect_left(self.variableAddress, address)
+        if i < len(self.variables) and self.variables[i][0] == address:
+            return self.variables[i][1]
+        return None
+
+    def line_at(self, address):
+        i = bisect_right(self.lineAddress, address)
+        return self.lines[i - 1][1] if i else None
+
+
+def write_symbols(assembler, fout):
+    with atomic_open(fout, "w") as f:
+        json.dump(assembler.symbol_map(), f, separators=(",", ":"))
+
+
+@contextmanager
+def atomic_open(fout, mode="w"):
+    # write next to the target and rename over it, so a reader (or a build
+    # that is interrupted halfway) never sees a partially written file
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fout)), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        # mkstemp makes the file private; give it the target's mode, or the
+        # one open() would have created it with
+        try:
+            permissions = os.stat(fout).st_mode & 0o7777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            permissions = 0o666 & ~umask
+        os.chmod(tmp, permissions)
+        os.replace(tmp, fout)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def render_hack(words):
+    return "".join([padding(x) + "\n" for x in words]).encode("ascii")
+
+
+def render_binary(words):
+    # packed little-endian 16-bit words, 2 bytes per instruction
+    words = array("H", words)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def write_hack(words, fout):
+    with atomic_open(fout, "wb") as f:
+        f.write(render_hack(words))
+
+
+def write_binary(words, fout):
+    with atomic_open(fout, "wb") as f:
+        f.write(render_binary(words))
+
+
+def read_hack(fin):
+    with open(fin, "r") as f:
+        return array("H", [int(line, 2) for line in f if line.strip()])
+
+
+def read_binary(fin):
+    # the ROM is memory-mapped rather than read; the returned memoryview of
+    # "H" items keeps the mapping alive for as long as it is referenced
+    with open(fin, "rb") as f:
+        if sys.byteorder != "little" or not f.seek(0, 2):
+            f.seek(0)
+            words = array("H", f.read())
+            if sys.byteorder != "little":
+                words.byteswap()
+            return words
+        rom = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(rom).cast("H")
+
+
+def load(fin):
+    if fin.endswith(".hack"):
+        return read_hack(fin)
+    return read_binary(fin)
+
+
+# extension, renderer and bytes per instruction of every output format
+outputFormat = {
+    "text": (".hack", render_hack, 17),
+    "binary": (".bin", render_binary, 2),
+}
+
+
+def assemble_file(fin, fout=None, assembler=None, fmt="text"):
+    extension, render, _ = outputFormat[fmt]
+    if fout is None:
+        fout = read_name(fin) + extension
+    if assembler is None:
+        assembler = Assembler()
+    with open(fin, "r") as f:
+        hack = assembler.assemble(f)
+    with atomic_open(fout, "wb") as f:
+        f.write(render(hack))
+    return hack
+
+
+def stream_file(fin, fout=None, assembler=None, fmt="text", chunk=4096):
+    """Assemble fin into fout without holding the program in memory: words
+    are written out as they are encoded, and since every word has the same
+    width the forward references are patched in place afterwards. Returns
+    the number of instructions."""
+    extension, render, width = outputFormat[fmt]
+    if fout is None:
+        fout = read_name(fin) + extension
+    if assembler is None:
+        assembler = Assembler()
+    count = 0
+    with open(fin, "r") as src, atomic_open(fout, "w+b") as f:
+        words = assembler.stream(src)
+        while True:
+            block = array("H", islice(words, chunk))
+            if not block:
+                break
+            f.write(render(block))
+            count += len(block)
+        for i, address in assembler.patches():
+            f.seek(i * width)
+            f.write(render((address,)))
+    return count
+
+
+def collect_inputs(patterns):
+    # a directory means every .asm below it, anything else is a glob pattern
+    # (a plain file name being the trivial one)
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files += sorted(
+                glob.glob(os.path.join(pattern, "**", "*.asm"), recursive=True)
+            )
+        elif glob.has_magic(pattern):
+            files += sorted(glob.glob(pattern, recursive=True))
+        else:
+            files.append(pattern)
+    return files
+
+
+class AssemblyCache:
+    """On-disk cache of assembled outputs, keyed by the content hash of the
+    source together with the assembler version and the output format. The
+    modification time of an entry doubles as its last use, and the least
+    recently used entries are evicted once the cache outgrows max_bytes."""
+
+    def __init__(self, directory, max_bytes=64 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source, *options):
+        # source is a binary file, hashed a block at a time
+        digest = hashlib.sha256()
+        digest.update("\0".join((VERSION,) + options + ("",)).encode())
+        for block in iter(lambda: source.read(1 << 16), b""):
+            digest.update(block)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def fetch(self, key, fout):
+        entry = self.path(key)
+        try:
+            os.utime(entry)
+            with atomic_open(fout, "wb") as f, open(entry, "rb") as cached:
+                shutil.copyfileobj(cached, f)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key, fout):
+        with atomic_open(self.path(key), "wb") as f, open(fout, "rb") as built:
+            shutil.copyfileobj(built, f)
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def default_cache_dir():
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(root, "hack-assembler")
+
+
+def output_size(fout, fmt):
+    # number of instructions in an output file, without parsing it
+    return os.path.getsize(fout) // outputFormat[fmt][2]
+
+
+def build_file(fin, fout=None, assembler=None, fmt="text", cache=None, stream=False):
+    """Assemble one file, going through the cache when one is given. Returns
+    the number of instructions and whether the output was a cache hit."""
+    if fout is None:
+        fout = read_name(fin) + outputFormat[fmt][0]
+    if assembler is None:
+        assembler = Assembler()
+    if assembler.listing:
+        # the symbol map comes out of an actual run, so the cache is bypassed
+        cache = None
+    if cache is not None:
+        with open(fin, "rb") as f:
+            key = cache.key(f, fmt, "optimize" if assembler.optimize else "")
+        if cache.fetch(key, fout):
+            return output_size(fout, fmt), True
+    if stream:
+        count = stream_file(fin, fout, assembler, fmt)
+    else:
+        count = len(assemble_file(fin, fout, assembler, fmt))
+    if assembler.listing:
+        write_symbols(assembler, read_name(fout) + ".sym")
+    if cache is not None:
+        cache.store(key, fout)
+    return count, False
+
+
+def _assemble_job(job):
+    fin, fmt, cache, stream, assembler = job
+    start = time.perf_counter()
+    count, hit = build_file(fin, None, assembler, fmt, cache, stream)
+    elapsed = time.perf_counter() - start
+    # a cache hit runs nothing, so the count left is another file's
+    return fin, count, elapsed, hit, 0 if hit else assembler.peephole.removed
+
+
+def assemble_files(
+    files, fmt="text", jobs=None, cache=None, stream=False, assembler=None
+):
+    """Assemble many files, fanned out over a process pool when there is more
+    than one file and more than one job; every worker gets its own copy of
+    the given assembler. Yields (file, instructions, seconds, cache hit,
+    instructions removed by the peephole stage) in input order."""
+    if assembler is None:
+        assembler = Assembler()
+    work = [(fin, fmt, cache, stream, assembler) for fin in files]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(work))
+    if jobs <= 1:
+        for fin in files:
+            start = time.perf_counter()
+            count, hit = build_file(fin, None, assembler, fmt, cache, stream)
+            elapsed = time.perf_counter() - start
+            yield fin, count, elapsed, hit, 0 if hit else assembler.peephole.removed
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        chunksize = max(1, len(work) // (jobs * 4))
+        yield from pool.map(_assemble_job, work, chunksize=chunksize)
+
+
+def reduction(name, count, removed):
+    before = count + removed
+    return "{}: {} -> {} instructions, {} removed ({:.1f}%)".format(
+        name, before, count, removed, 100 * removed / before if before else 0
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(description="A hack language assembler")
-    parser.add_argument("fin", help="the input assembly language file (ends with .asm)")
+    parser.add_argument(
+        "fin",
+        nargs="+",
+        help="the input assembly language file(s) (ends with .asm), directories "
+        "or glob patterns; several files are assembled in a process pool",
+    )
     parser.add_argument(
         "-o", default="#", help="(optional) the output machine language file"
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=sorted(outputFormat),
+        default="text",
+        help="(optional) text .hack (default) or packed little-endian 16-bit .bin",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="(optional) number of worker processes, defaults to the CPU count",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="(optional) where assembled outputs are cached, "
+        "defaults to $XDG_CACHE_HOME/hack-assembler",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="(optional) cache size limit in MiB, least recently used "
+        "outputs are evicted beyond it",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="(optional) always reassemble"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="(optional) encode and write the program line by line instead of "
+        "loading it, for sources too large to hold in memory",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="(optional) run the peephole optimizer and report the "
+        "instructions it saves",
+    )
+    parser.add_argument(
+        "-s",
+        "--symbols",
+        action="store_true",
+        help="(optional) also write a .sym index of labels, variables and "
+        "source lines by address (bypasses the cache)",
+    )
     args = parser.parse_args()
-    if args.o == "#":
-        args.o = read_name(args.fin) + ".hack"
-    with open(args.fin, "r") as f:
-        code = f.readlines()
-
-    code = [modifyLine(x) for x in code]
-    code = list(filter(lambda x: x != "", code))
-
-    pc = 0
-    for line, i in zip(code, range(len(code))):
-        if line[0] == "(":
-            new_line_marker(line, pc)
-        else:
-            pc += 1
-
-    hack = []
-    for line in code:
-        if line == "":
-            continue
-        if line[0] == "@":
-            hack.append(translate_A_command(line))
-        elif line[0] != "(":
-            hack.append(translate_C_command(line))
+    files = collect_inputs(args.fin)
+    if args.o != "#" and len(files) != 1:
+        parser.error("-o can only be used with a single input file")
+    cache = None
+    if not args.no_cache:
+        cache = AssemblyCache(args.cache_dir, args.cache_size << 20)
 
-    with open(args.o, "w") as f:
-        for each in hack:
-            print(each, file=f)
+    if len(files) == 1:
+        fout = None if args.o == "#" else args.o
+        assembler = Assembler(args.optimize, args.symbols)
+        count, hit = build_file(
+            files[0], fout, assembler, args.format, cache, args.stream
+        )
+        if args.optimize and not hit:
+            print(reduction(files[0], count, assembler.peephole.removed))
+        if cache is not None:
+            print("cache: {} hits, {} misses".format(int(hit), 1 - hit))
+    else:
+        start = time.perf_counter()
+        total = hits = saved = 0
+        for fin, count, elapsed, hit, removed in assemble_files(
+            files,
+            args.format,
+            args.jobs,
+            cache,
+            args.stream,
+            Assembler(args.optimize, args.symbols),
+        ):
+            total += count
+            hits += hit
+            saved += removed
+            print(
+                "{}: {} instructions in {:.1f} ms{}".format(
+                    fin, count, elapsed * 1000, " (cached)" if hit else ""
+                )
+            )
+            if removed:
+                print("  " + reduction(fin, count, removed))
+        print(
+            "{} files, {} instructions in {:.1f} ms".format(
+                len(files), total, (time.perf_counter() - start) * 1000
+            )
+        )
+        if args.optimize:
+            print(reduction("total", total, saved))
+        if cache is not None:
+            print("cache: {} hits, {} misses".format(hits, len(files) - hits))
+    if cache is not None:
+        cache.evict()
 
 
-main()
+if __name__ == "__main__":
+    main()
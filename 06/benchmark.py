@@ -0,0 +1,223 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import assembler
+import emulator
+
+# instructions per second the emulator is expected to sustain on Pong
+EMULATOR_TARGET = 2e6
+
+
+def legacy_assemble(lines):
+    # the original two-pass assembler: every C-instruction is re-split and
+    # every word padded bit by bit; kept here as the baseline to measure against
+    symTable = dict(assembler.symTable)
+    cnt = 0x000F
+
+    def padding(x, l=16):
+        s = bin(int(x))[2:]
+        return "".join(["0" for i in range(l - len(s))]) + s
+
+    def readsym(name):
+        nonlocal cnt
+        if name in symTable.keys():
+            return symTable[name]
+        if len(name) > 1 and name[0] == "R" and assembler.isnumber(name[1:]):
+            return int(name[1:])
+        cnt += 1
+        symTable.setdefault(name, cnt)
+        return cnt
+
+    def translate_C_command(st):
+        i = st.find("=")
+        j = st.find(";")
+        if i == -1 and j == -1:
+            dest, comp, jmp = "", st, ""
+        elif i == -1:
+            dest, comp, jmp = "", st[:j], st[j + 1 :]
+        elif j == -1:
+            dest, comp, jmp = st[:i], st[i + 1 :], ""
+        else:
+            dest, comp, jmp = st[:i], st[i + 1 : j], st[j + 1 :]
+        D = ["0", "0", "0"]
+        if "A" in dest:
+            D[0] = "1"
+        if "D" in dest:
+            D[1] = "1"
+        if "M" in dest:
+            D[2] = "1"
+        if "M" in comp:
+            A = "1"
+            comp = comp.replace("M", "A")
+        else:
+            A = "0"
+        C = assembler.CTable[comp]
+        J = assembler.JTable[jmp]
+        return "111" + A + C + "".join(D) + J
+
+    code = [assembler.modifyLine(x) for x in lines]
+    code = list(filter(lambda x: x != "", code))
+
+    pc = 0
+    for line in code:
+        if line[0] == "(":
+            symTable.setdefault(line[1:-1], pc)
+        else:
+            pc += 1
+
+    hack = []
+    for line in code:
+        if line[0] == "@":
+            st = line[1:]
+            hack.append(padding(st if assembler.isnumber(st) else readsym(st)))
+        elif line[0] != "(":
+            hack.append(translate_C_command(line))
+    return hack
+
+
+def engine_assemble(lines):
+    # start cold so the C-instruction cache is not carried between repetitions
+    assembler.CCache.clear()
+    return [assembler.padding(x) for x in assembler.assemble(lines)]
+
+
+def measure(func, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(lines)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def scaled_source(lines, copies, fout):
+    # the program repeated `copies` times, standing in for a large generated
+    # dump; labels are only defined by the first copy so that every address
+    # still fits in a word
+    body = [line for line in lines if not line.strip().startswith("(")]
+    with open(fout, "w") as f:
+        f.writelines(lines)
+        for _ in range(copies - 1):
+            f.writelines(body)
+    return len(lines) + len(body) * (copies - 1)
+
+
+def peak_rss(fin, stream):
+    # assemble in a fresh interpreter and report its peak resident set in KiB
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = (
+        "import resource, sys; sys.path.insert(0, {!r}); import assembler; "
+        "assembler.{}({!r}, {!r}); "
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    ).format(
+        here, "stream_file" if stream else "assemble_file", fin, fin + ".hack"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, check=True
+    )
+    return int(out.stdout)
+
+
+def memory(lines, scales):
+    with tempfile.TemporaryDirectory() as tmp:
+        print("{:>10} {:>14} {:>14}".format("lines", "in-memory KiB", "stream KiB"))
+        for copies in scales:
+            fin = os.path.join(tmp, "Scaled.asm")
+            count = scaled_source(lines, copies, fin)
+            print(
+                "{:>10} {:>14} {:>14}".format(
+                    count, peak_rss(fin, False), peak_rss(fin, True)
+                )
+            )
+
+
+def emulate(lines, cycles, repeat):
+    # the labels double as block leaders for the compiled mode
+    source = assembler.Assembler(listing=True)
+    rom = source.assemble(lines)
+    leaders = [address for address, _ in source.symbol_map()["labels"]]
+    rates = {}
+    for name, make in (
+        ("interpreted", lambda: emulator.Hack(rom)),
+        ("compiled", lambda: emulator.JitHack(rom, leaders)),
+    ):
+        best = None
+        for _ in range(repeat):
+            hack = make()
+            start = time.perf_counter()
+            n = hack.run(cycles)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        rates[name] = n / best
+        print("{:12} {} instructions in {:.3f} s".format(name, n, best))
+    rate = rates["interpreted"]
+    verdict = "met" if rate >= EMULATOR_TARGET else "missed"
+    print(
+        "interpreted  {:.2f} M instructions/s, target {:.2f} M: {}".format(
+            rate / 1e6, EMULATOR_TARGET / 1e6, verdict
+        )
+    )
+    print(
+        "compiled     {:.2f} M instructions/s, {:.2f}x".format(
+            rates["compiled"] / 1e6, rates["compiled"] / rate
+        )
+    )
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the hack assembler")
+    parser.add_argument(
+        "fin",
+        nargs="?",
+        default=os.path.join(here, "pong", "Pong.asm"),
+        help="(optional) the assembly file to benchmark on",
+    )
+    parser.add_argument("-n", type=int, default=5, help="repetitions, best is kept")
+    parser.add_argument(
+        "--memory",
+        type=int,
+        nargs="*",
+        metavar="COPIES",
+        help="measure peak RSS of the in-memory and streaming assemblers on the "
+        "input repeated this many times (default 1 4 16)",
+    )
+    parser.add_argument(
+        "--emulate",
+        type=int,
+        metavar="CYCLES",
+        help="run the assembled program in the emulator for this many "
+        "instructions and report the instruction rate",
+    )
+    args = parser.parse_args()
+
+    with open(args.fin, "r") as f:
+        lines = f.readlines()
+
+    if args.memory is not None:
+        memory(lines, args.memory or [1, 4, 16])
+        return
+    if args.emulate is not None:
+        emulate(lines, args.emulate, args.n)
+        return
+
+    legacy_time, legacy = measure(legacy_assemble, lines, args.n)
+    engine_time, engine = measure(engine_assemble, lines, args.n)
+    if legacy != engine:
+        raise AssertionError("engine output differs from the legacy assembler")
+
+    print("{}: {} lines".format(args.fin, len(lines)))
+    print("legacy  {:10.0f} lines/s".format(len(lines) / legacy_time))
+    print("engine  {:10.0f} lines/s".format(len(lines) / engine_time))
+    print("speedup {:10.2f}x".format(legacy_time / engine_time))
+
+
+if __name__ == "__main__":
+    main()
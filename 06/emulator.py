@@ -0,0 +1,348 @@
+import argparse
+import os
+import time
+from array import array
+
+import assembler
+
+SCREEN = 16384
+KBD = 24576
+
+
+def wrap(x):
+    # two's complement 16-bit view of an int
+    return ((x + 0x8000) & 0xFFFF) - 0x8000
+
+
+# comp bits c1..c6 -> ALU function of (D, A or M); the a bit picks A or M
+compTable = {
+    0b101010: lambda x, y: 0,
+    0b111111: lambda x, y: 1,
+    0b111010: lambda x, y: -1,
+    0b001100: lambda x, y: x,
+    0b110000: lambda x, y: y,
+    0b001101: lambda x, y: ~x,
+    0b110001: lambda x, y: ~y,
+    0b001111: lambda x, y: wrap(-x),
+    0b110011: lambda x, y: wrap(-y),
+    0b011111: lambda x, y: wrap(x + 1),
+    0b110111: lambda x, y: wrap(y + 1),
+    0b001110: lambda x, y: wrap(x - 1),
+    0b110010: lambda x, y: wrap(y - 1),
+    0b000010: lambda x, y: wrap(x + y),
+    0b010011: lambda x, y: wrap(x - y),
+    0b000111: lambda x, y: wrap(y - x),
+    0b000000: lambda x, y: x & y,
+    0b010101: lambda x, y: x | y,
+}
+
+# jump bits -> condition on the ALU output, None for no jump
+jumpTable = {
+    0b000: None,
+    0b001: lambda out: out > 0,
+    0b010: lambda out: out == 0,
+    0b011: lambda out: out >= 0,
+    0b100: lambda out: out < 0,
+    0b101: lambda out: out != 0,
+    0b110: lambda out: out <= 0,
+    0b111: lambda out: True,
+}
+
+
+def decode(word):
+    """Pre-decode one ROM word. An A-instruction stays the int it loads, a
+    C-instruction becomes (ALU function, reads M, writes A, writes D,
+    writes M, jump condition)."""
+    if word < 0x8000:
+        return word
+    alu = compTable.get((word >> 6) & 0x3F)
+    if alu is None:
+        raise ValueError("invalid comp field in {:016b}".format(word))
+    return (
+        alu,
+        bool(word & 0x1000),
+        bool(word & 0x20),
+        bool(word & 0x10),
+        bool(word & 0x08),
+        jumpTable[word & 0x7],
+    )
+
+
+class Hack:
+    """The Hack computer: 32K words of ROM run against 32K words of RAM, the
+    screen and keyboard being the memory maps at SCREEN and KBD. Every ROM
+    word is decoded once when the program is loaded, so running is a table
+    walk rather than bit twiddling per instruction."""
+
+    def __init__(self, rom):
+        self.rom = array("H", rom)
+        self.program = [decode(word) for word in self.rom]
+        self.ram = array("h", bytes(2 * 0x8000))
+        self.reset()
+
+    @classmethod
+    def from_file(cls, fin):
+        # a text .hack or a binary ROM, as written by the assembler
+        return cls(assembler.load(fin))
+
+    def reset(self):
+        self.A = self.D = self.pc = 0
+        self.cycles = 0
+
+    def run(self, cycles):
+        """Execute up to `cycles` instructions, stopping early when the program
+        counter leaves the ROM. Returns the number executed."""
+        program = self.program
+        size = len(program)
+        ram = self.ram
+        A, D, pc = self.A, self.D, self.pc
+        n = 0
+        while n < cycles and 0 <= pc < size:
+            ins = program[pc]
+            n += 1
+            if ins.__class__ is int:
+                A = ins
+                pc += 1
+                continue
+            alu, readM, setA, setD, setM, jump = ins
+            address = A & 0x7FFF
+            out = alu(D, ram[address] if readM else A)
+            if setM:
+                ram[address] = out
+            if jump is not None and jump(out):
+                pc = A & 0x7FFF
+            else:
+                pc += 1
+            if setA:
+                A = out
+            if setD:
+                D = out
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += n
+        return n
+
+
+# comp bits c1..c6 -> the same ALU functions as Python expressions of x and y,
+# for the block compiler
+compSource = {
+    0b101010: "0",
+    0b111111: "1",
+    0b111010: "-1",
+    0b001100: "{x}",
+    0b110000: "{y}",
+    0b001101: "~{x}",
+    0b110001: "~{y}",
+    0b001111: "(-{x} + 32768 & 65535) - 32768",
+    0b110011: "(-{y} + 32768 & 65535) - 32768",
+    0b011111: "({x} + 32769 & 65535) - 32768",
+    0b110111: "({y} + 32769 & 65535) - 32768",
+    0b001110: "({x} + 32767 & 65535) - 32768",
+    0b110010: "({y} + 32767 & 65535) - 32768",
+    0b000010: "({x} + {y} + 32768 & 65535) - 32768",
+    0b010011: "({x} - {y} + 32768 & 65535) - 32768",
+    0b000111: "({y} - {x} + 32768 & 65535) - 32768",
+    0b000000: "{x} & {y}",
+    0b010101: "{x} | {y}",
+}
+
+jumpSource = {
+    0b001: "out > 0",
+    0b010: "out == 0",
+    0b011: "out >= 0",
+    0b100: "out < 0",
+    0b101: "out != 0",
+    0b110: "out <= 0",
+}
+
+
+class JitHack(Hack):
+    """Hack computer that runs compiled basic blocks instead of single
+    instructions. A block is the straight-line code from an address up to
+    the next jump, or up to the next leader (e.g. a label address from the
+    assembler's symbol map). While compiling, A is tracked as a constant
+    after every @value, so addresses and operands are folded into the code.
+
+    Blocks are not called one by one: the first time the program counter
+    reaches an address, the blocks reachable from it through jumps with
+    constant targets (up to region_size of them) are compiled into a single
+    Python function that loops between them, so a tight loop runs inside
+    one function call. Compiled regions are cached by entry address."""
+
+    def __init__(self, rom, leaders=(), region_size=16):
+        super().__init__(rom)
+        self.leaders = frozenset(leaders)
+        self.region_size = region_size
+        self.regions = {}
+
+    @classmethod
+    def from_file(cls, fin):
+        # use the labels of an accompanying .sym file as block leaders
+        sym = assembler.read_name(fin) + ".sym"
+        leaders = ()
+        if os.path.exists(sym):
+            leaders = [x[0] for x in assembler.SymbolMap.load(sym).labels]
+        return cls(assembler.load(fin), leaders)
+
+    def compile_block(self, pc):
+        """Python source for the block at pc. Returns its statements, its
+        length, the expression of the next pc and the constant addresses that
+        expression can take (None when it jumps to a computed address)."""
+        rom = self.rom
+        size = len(rom)
+        code = []
+        known = None  # value of A while it is a compile-time constant
+        i = pc
+        end = None
+        successors = []
+        while i < size:
+            word = rom[i]
+            i += 1
+            if word < 0x8000:
+                known = word
+            else:
+                comp = compSource.get((word >> 6) & 0x3F)
+                if comp is None:
+                    raise ValueError("invalid comp field in {:016b}".format(word))
+                address = "A & 32767" if known is None else str(known)
+                if word & 0x1000:
+                    y = "ram[{}]".format(address)
+                else:
+                    y = "A" if known is None else str(known)
+                expr = comp.format(x="D", y=y)
+                jump = word & 0x7
+                targets = []
+                if word & 0x08:
+                    targets.append("ram[{}]".format(address))
+                if word & 0x10:
+                    targets.append("D")
+                if jump:
+                    if known is None:
+                        # the jump goes to A as it was before this instruction
+                        code.append("target = A & 32767")
+                        address = "target"
+                        successors = None
+                    else:
+                        successors.append(known)
+                    if jump == 0b111:
+                        end = address
+                    else:
+                        # test D when the result lands there anyway
+                        if "D" not in targets:
+                            targets.append("out")
+                        condition = jumpSource[jump]
+                        if "D" in targets:
+                            condition = condition.replace("out", "D")
+                        end = "{} if {} else {}".format(address, condition, i)
+                        if successors is not None:
+                            successors.append(i)
+                if word & 0x20:
+                    targets.append("A")
+                    known = None
+                if targets:
+                    code.append(" = ".join(targets) + " = " + expr)
+                if jump:
+                    break
+            if i in self.leaders:
+                break
+        if known is not None:
+            code.append("A = {}".format(known))
+        if end is None:
+            end = str(i)
+            successors = [i]
+        return code, i - pc, end, successors
+
+    def compile_region(self, pc):
+        size = len(self.rom)
+        order = [pc]
+        blocks = {}
+        for entry in order:
+            blocks[entry] = block = self.compile_block(entry)
+            for successor in block[3] or ():
+                if (
+                    successor not in blocks
+                    and successor not in order
+                    and successor < size
+                    and len(order) < self.region_size
+                ):
+                    order.append(successor)
+        source = [
+            "def region(A, D, ram, budget):",
+            "    pc = {}".format(pc),
+            "    n = 0",
+            "    while True:",
+        ]
+        for k, entry in enumerate(order):
+            code, length, end, _ = blocks[entry]
+            source.append("        {} pc == {}:".format("elif" if k else "if", entry))
+            source.append("            if n + {} > budget:".format(length))
+            source.append("                break")
+            source += ["            " + line for line in code]
+            source.append("            n += {}".format(length))
+            source.append("            pc = {}".format(end))
+        source += ["        else:", "            break", "    return A, D, pc, n", ""]
+        namespace = {}
+        exec(compile("\n".join(source), "<region {}>".format(pc), "exec"), namespace)
+        return namespace["region"]
+
+    def run(self, cycles):
+        """Execute up to `cycles` instructions a region at a time; whatever is
+        left once the next block would overshoot is run one instruction at a
+        time, so the count is exact. Returns the number executed."""
+        regions = self.regions
+        size = len(self.program)
+        ram = self.ram
+        A, D, pc = self.A, self.D, self.pc
+        n = 0
+        while 0 <= pc < size:
+            region = regions.get(pc)
+            if region is None:
+                region = regions[pc] = self.compile_region(pc)
+            A, D, pc, k = region(A, D, ram, cycles - n)
+            if not k:
+                break
+            n += k
+        self.A, self.D, self.pc = A, D, pc
+        self.cycles += n
+        if n < cycles and 0 <= pc < size:
+            n += Hack.run(self, cycles - n)
+        return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A hack computer emulator")
+    parser.add_argument("fin", help="the program to run (.hack or binary .bin)")
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=10_000_000,
+        help="(optional) number of instructions to execute",
+    )
+    parser.add_argument(
+        "--jit",
+        action="store_true",
+        help="(optional) compile basic blocks to Python functions; labels from "
+        "a .sym file next to the program are used as block leaders",
+    )
+    parser.add_argument(
+        "--dump",
+        default="",
+        help="(optional) comma separated RAM addresses to print afterwards",
+    )
+    args = parser.parse_args()
+
+    hack = (JitHack if args.jit else Hack).from_file(args.fin)
+    start = time.perf_counter()
+    n = hack.run(args.cycles)
+    elapsed = time.perf_counter() - start
+    print(
+        "{} instructions in {:.3f} s, {:.2f} M instructions/s".format(
+            n, elapsed, n / elapsed / 1e6 if elapsed else 0
+        )
+    )
+    for address in filter(None, args.dump.split(",")):
+        print("RAM[{}] = {}".format(address, hack.ram[int(address)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,10 @@
 import argparse
 import os
+import sys
 
-
-class Parser:
-    commandTypeTable = {
-        "label": "C_LABEL",
-        "function": "C_FUNCTION",
-        "push": "C_PUSH",
-        "pop": "C_POP",
-        "goto": "C_GOTO",
-        "if-goto": "C_IF",
-        "return": "C_RETURN",
-        "call": "C_CALL",
-        "add": "C_ARITHMETIC",
-        "sub": "C_ARITHMETIC",
-        "neg": "C_ARITHMETIC",
-        "eq": "C_ARITHMETIC",
-        "gt": "C_ARITHMETIC",
-        "lt": "C_ARITHMETIC",
-        "and": "C_ARITHMETIC",
-        "or": "C_ARITHMETIC",
-        "not": "C_ARITHMETIC",
-    }
-
-    def __init__(self, fd):
-        self.file = fd.readlines()
-        self.file = [Parser.modifyLine(x) for x in self.file]
-        self.file = list(filter(lambda x: x != "", self.file))
-        self.file_length = len(self.file)
-
-        self.index = -1
-        self.command = ""
-        self.command_type = self.arg_1 = self.arg_2 = ""
-
-    def hasMoreCommands(self):
-        return self.index < self.file_length - 1
-
-    def advance(self):
-        self.index += 1
-        line = self.file[self.index].split(" ")
-        self.command = line[0]
-        self.command_type = Parser.commandTypeTable[line[0]]
-        try:
-            self.arg_1 = line[1]
-            self.arg_2 = line[2]
-        except:
-            pass
-
-    def commandType(self):
-        return self.command_type
-
-    def arg1(self):
-        assert self.command_type != "C_RETURN"
-        if self.command_type == "C_ARITHMETIC":
-            return self.command
-        return self.arg_1
-
-    def arg2(self):
-        assert self.command_type in ("C_PUSH", "C_POP", "C_FUNCTION", "C_CALL")
-        return int(self.arg_2)
-
-    def modifyLine(line):
-        line = line[:-1]
-        i = line.find("//")
-        if i != -1:
-            line = line[:i]
-
-        line = line.replace("\t", "").strip()
-        return line
+# the VM front-end is shared with the full translator of 08
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "08"))
+import vmparser  # noqa: E402
 
 
 str1 = """@SP
@@ -189,22 +126,20 @@ def main():
         inputFiles = [fin]
         writer = CodeWriter(read_name(fin) + ".asm")
     else:
-        inputFiles = list(filter(lambda x: read_extension(x) == ".vm", os.listdir(fin)))
+        inputFiles = [
+            os.path.join(fin, x) for x in os.listdir(fin) if read_extension(x) == "vm"
+        ]
         writer = CodeWriter(fin + ".asm")
 
     for filename in inputFiles:
-        with open(filename, "r") as fd:
-            parser = Parser(fd)
+        program = vmparser.Program.from_file(filename)
         writer.setFileName(read_name(os.path.basename(filename)))
 
-        while parser.hasMoreCommands():
-            parser.advance()
-            if parser.commandType() == "C_ARITHMETIC":
-                writer.writeArithmetic(parser.arg1())
-            if parser.commandType() == "C_POP":
-                writer.writePushPop("pop", parser.arg1(), parser.arg2())
-            if parser.commandType() == "C_PUSH":
-                writer.writePushPop("push", parser.arg1(), parser.arg2())
+        for op, name, value in program:
+            if op == vmparser.PUSH or op == vmparser.POP:
+                writer.writePushPop(vmparser.opcodeNames[op], name, value)
+            elif op <= vmparser.NOT:
+                writer.writeArithmetic(vmparser.opcodeNames[op])
 
 
 if __name__ == "__main__":
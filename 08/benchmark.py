@@ -0,0 +1,643 @@
+import argparse
+import functools
+import glob
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import profiler
+import translator
+import vmemulator
+import vmparser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "06"))
+import assembler  # noqa: E402
+import emulator  # noqa: E402
+
+# 0;JMP, the second half of an `(L) @L 0;JMP` halting loop
+JMP = 0b1110101010000111
+
+
+class PrintWriter(translator.CodeWriter):
+    # the previous emission path: one print() per VM command, which also
+    # adds a blank line after each; kept as the baseline to measure against
+    def __init__(self, file, isdir):
+        self.out = open(file, "w")
+        super().__init__(file, isdir)
+
+    def emit(self, st):
+        print(st, file=self.out)
+
+    def close(self):
+        self.out.close()
+
+
+# the string-based parser translate() went through before the Program IR;
+# kept here as the baseline to measure against
+class Parser:
+    commandTypeTable = {
+        "label": "C_LABEL",
+        "function": "C_FUNCTION",
+        "push": "C_PUSH",
+        "pop": "C_POP",
+        "goto": "C_GOTO",
+        "if-goto": "C_IF",
+        "return": "C_RETURN",
+        "call": "C_CALL",
+        "add": "C_ARITHMETIC",
+        "sub": "C_ARITHMETIC",
+        "neg": "C_ARITHMETIC",
+        "eq": "C_ARITHMETIC",
+        "gt": "C_ARITHMETIC",
+        "lt": "C_ARITHMETIC",
+        "and": "C_ARITHMETIC",
+        "or": "C_ARITHMETIC",
+        "not": "C_ARITHMETIC",
+    }
+
+    def __init__(self, fd):
+        self.file = fd.readlines()
+        self.file = [Parser.modifyLine(x) for x in self.file]
+        self.file = list(filter(lambda x: x != "", self.file))
+        self.file_length = len(self.file)
+
+        self.index = -1
+        self.command = ""
+        self.command_type = self.arg_1 = self.arg_2 = ""
+
+    def hasMoreCommands(self):
+        return self.index < self.file_length - 1
+
+    def advance(self):
+        self.index += 1
+        line = self.file[self.index].split(" ")
+        self.command = line[0]
+        self.command_type = Parser.commandTypeTable[line[0]]
+        try:
+            self.arg_1 = line[1]
+            self.arg_2 = line[2]
+        except:
+            pass
+
+    def commandType(self):
+        return self.command_type
+
+    def arg1(self):
+        assert self.command_type != "C_RETURN"
+        if self.command_type == "C_ARITHMETIC":
+            return self.command
+        return self.arg_1
+
+    def arg2(self):
+        assert self.command_type in ("C_PUSH", "C_POP", "C_FUNCTION", "C_CALL")
+        return int(self.arg_2)
+
+    def modifyLine(line):
+        line = line[:-1]
+        i = line.find("//")
+        if i != -1:
+            line = line[:i]
+
+        line = line.replace("\t", "").strip()
+        return line
+
+
+def translate_dir(directory, writer_class, fout, jobs=None, rom=None, optimizer=None):
+    files = sorted(glob.glob(os.path.join(directory, "*.vm")))
+    writer = writer_class(fout, len(files) > 1)
+    if jobs and writer.multiple:
+        commands = translator.translate_parallel(files, writer, jobs, None, optimizer)
+    else:
+        commands = sum(
+            translator.translate(f, writer, None, optimizer) for f in files
+        )
+    if writer.multiple:
+        writer.writeMain()
+    if rom:
+        translator.write_rom(writer, rom)
+    else:
+        writer.close()
+    return commands
+
+
+def measure(dirs, writer_class, repeat, fout, jobs=None):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        commands = sum(translate_dir(d, writer_class, fout, jobs) for d in dirs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return commands, best
+
+
+def build(dirs, repeat):
+    """.vm to .hack build time: translating to assembly and assembling it,
+    against encoding the ROM directly in the translator."""
+    with tempfile.TemporaryDirectory() as tmp:
+        fout = os.path.join(tmp, "out.asm")
+
+        def through_asm():
+            for d in dirs:
+                translate_dir(d, translator.CodeWriter, fout)
+                assembler.assemble_file(fout)
+
+        def direct():
+            for d in dirs:
+                translate_dir(d, translator.CodeWriter, fout, rom="text")
+
+        times = []
+        for func in (through_asm, direct):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            times.append(best)
+    print("{} directories".format(len(dirs)))
+    print(".asm + assembler {:8.2f} ms".format(times[0] * 1e3))
+    print("direct ROM       {:8.2f} ms".format(times[1] * 1e3))
+    print("speedup          {:8.2f}x".format(times[0] / times[1]))
+
+
+def legacy_parse(source):
+    # walk the commands through the string-based Parser, as translate() did
+    parser = Parser(io.StringIO(source))
+    commands = []
+    while parser.hasMoreCommands():
+        parser.advance()
+        kind = parser.commandType()
+        arg1 = arg2 = None
+        if kind != "C_RETURN":
+            arg1 = parser.arg1()
+        if kind in ("C_PUSH", "C_POP", "C_FUNCTION", "C_CALL"):
+            arg2 = parser.arg2()
+        commands.append((kind, arg1, arg2))
+    return parser, commands
+
+
+def ir_parse(source):
+    program = translator.Program().parse(io.StringIO(source))
+    return program, list(program)
+
+
+def parse_memory(func, sources):
+    # bytes held by the parsed form of every source
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parsed = [func(source)[0] for source in sources]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del parsed
+    return size
+
+
+def parse(dirs, repeat):
+    sources = []
+    for directory in dirs:
+        for filename in sorted(glob.glob(os.path.join(directory, "*.vm"))):
+            with open(filename, "r") as f:
+                sources.append(f.read())
+    commands = None
+    rows = []
+    for name, func in (("Parser", legacy_parse), ("Program", ir_parse)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = sum(len(func(source)[1]) for source in sources)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        if commands is None:
+            commands = count
+        elif count != commands:
+            raise AssertionError("Program and Parser disagree on the commands")
+        rows.append((name, commands / best, parse_memory(func, sources) / commands))
+    print("{} files, {} VM commands".format(len(sources), commands))
+    for name, rate, size in rows:
+        print("{:8} {:10.0f} commands/s {:8.1f} bytes/command".format(name, rate, size))
+
+
+def presets(directory):
+    # RAM settings of the test script, e.g. a fake stack frame
+    values = {}
+    for tst in glob.glob(os.path.join(directory, "*.tst")):
+        if tst.endswith("VME.tst"):
+            continue
+        with open(tst, "r") as f:
+            settings = re.findall(r"set RAM\[(\d+)\]\s+(-?\d+)", f.read())
+        for address, value in settings:
+            values[int(address)] = int(value)
+    return values
+
+
+def expected(directory):
+    # RAM[address] -> value from the .cmp tables of the test
+    values = {}
+    for cmp in glob.glob(os.path.join(directory, "*.cmp")):
+        with open(cmp, "r") as f:
+            rows = [line for line in f if line.strip()]
+        for header, row in zip(rows[::2], rows[1::2]):
+            names = header.strip("|\n").split("|")
+            for name, value in zip(names, row.strip("|\n").split("|")):
+                values[int(re.search(r"\d+", name).group())] = int(value)
+    return values
+
+
+def execute(words, directory, limit=1000000):
+    """Run a translated test until it halts: it leaves the ROM or reaches an
+    `(L) @L 0;JMP` loop. Returns the cycles taken and whether the RAM
+    matches the .cmp file."""
+    hack = emulator.Hack(words)
+    for address, value in presets(directory).items():
+        hack.ram[address] = value
+    rom = hack.rom
+    while hack.cycles < limit:
+        pc = hack.pc
+        if not 0 <= pc < len(rom):
+            break
+        if rom[pc] == pc and pc + 1 < len(rom) and rom[pc + 1] == JMP:
+            break
+        hack.run(1)
+    passed = all(hack.ram[a] == v for a, v in expected(directory).items())
+    return hack.cycles, passed
+
+
+def run_vm(dirs, steps):
+    """VM commands per second of the VM emulator running every directory
+    until it halts or `steps` commands have run; programs with a bootstrap
+    ignore the RAM settings of their test, as the bootstrap makes its own."""
+    print("{:20} {:>10} {:>10} {:>14}".format("", "commands", "seconds", "commands/s"))
+    total = elapsed = 0
+    for directory in dirs:
+        vm = vmemulator.VM.from_path(directory)
+        if not vm.bootstrap:
+            for address, value in presets(directory).items():
+                vm.ram[address] = value
+        start = time.perf_counter()
+        n = vm.run(steps)
+        seconds = time.perf_counter() - start
+        total += n
+        elapsed += seconds
+        passed = all(vm.ram[a] == v for a, v in expected(directory).items())
+        print(
+            "{:20} {:>10} {:10.4f} {:14.0f}{}".format(
+                os.path.basename(directory),
+                n,
+                seconds,
+                n / seconds,
+                "" if passed else " !",
+            )
+        )
+    row = "{:20} {:>10} {:10.4f} {:14.0f}"
+    print(row.format("total", total, elapsed, total / elapsed))
+    print("(! marks a result that fails its .cmp)")
+    overflowing_compares()
+
+
+def overflowing_compares():
+    """Check that lt and gt give the same results in the VM emulator as
+    translated, where x - y overflows: the written code compares on the sign
+    of the 16-bit difference, so 20000 > -20000 is false."""
+    values = [-32768, -32767, -20000, -1, 0, 1, 20000, 32767]
+    program = vmparser.Program("Compare.vm")
+    count = 0
+    for x in values:
+        for y in values:
+            for op in (vmparser.LT, vmparser.GT):
+                for value in (x, y):
+                    for command in translator.Optimizer.constant(value):
+                        program.append(*command)
+                program.append(op)
+                program.append(vmparser.POP, "static", count)
+                count += 1
+    program.append(vmparser.LABEL, "END")
+    program.append(vmparser.GOTO, "END")
+
+    vm = vmemulator.VM([program], [program.filename], False)
+    vm.ram[0] = 256
+    vm.run(100 * count)
+    writer = translator.CodeWriter(None, False)
+    translator.translate_program(program, writer)
+    encoder = translator.RomEncoder()
+    hack = emulator.Hack(encoder.encode(writer.finish()))
+    hack.ram[0] = 256
+    hack.run(1000 * count)
+    differ = sum(
+        vm.ram[vm.static("Compare." + str(i))]
+        != hack.ram[encoder.variables["Compare." + str(i)]]
+        for i in range(count)
+    )
+    print(
+        "overflowing compares: {} of {} differ from the translated "
+        "code".format(differ, count)
+    )
+
+
+def run_native(dirs, steps, until):
+    """Time every directory in the VM emulator with the OS classes run as VM
+    code and as native code, up to the first call of `until` (or a halt, or
+    `steps` commands), and check that both leave the same RAM outside the
+    stack and temp."""
+    print("{:20} {:>22} {:>22}".format("", "VM code", "native OS"))
+    for directory in dirs:
+        cells = []
+        rams = []
+        for natives in ((), vmemulator.NativeOS.classes):
+            vm = vmemulator.VM.from_path(directory, natives)
+            if not vm.bootstrap:
+                for address, value in presets(directory).items():
+                    vm.ram[address] = value
+            if until in vm.functions:
+                vm.code[vm.functions[until]] = (vmemulator.HALT, 0, 0)
+            start = time.perf_counter()
+            n = vm.run(steps)
+            seconds = time.perf_counter() - start
+            cells.append((n, seconds))
+            rams.append(vm.ram[0:5] + vm.ram[13:256] + vm.ram[2048:])
+        (n1, t1), (n2, t2) = cells
+        print(
+            "{:20} {:>10} {:9.3f} s {:>10} {:9.3f} s {:6.2f}x{}".format(
+                os.path.basename(directory),
+                n1,
+                t1,
+                n2,
+                t2,
+                t1 / t2,
+                "" if rams[0] == rams[1] else " RAM differs",
+            )
+        )
+
+
+def compare(dirs, modes):
+    """ROM size and cycles to halt of every directory under each writer
+    configuration in `modes`, the first one being the baseline."""
+    print("{:20}".format("") + "".join("{:>29} ".format(name) for name in modes))
+    with tempfile.TemporaryDirectory() as tmp:
+        fout = os.path.join(tmp, "out.asm")
+        for directory in dirs:
+            cells = []
+            base = None
+            for writer_class in modes.values():
+                translate_dir(directory, writer_class, fout)
+                with open(fout, "r") as f:
+                    words = assembler.assemble(f)
+                cycles, passed = execute(words, directory)
+                if base is None:
+                    base = (len(words), cycles)
+                cells.append(
+                    "{:>8} {:+4.0f}% {:>8} {:+4.0f}%{:1}".format(
+                        len(words),
+                        100 * (len(words) - base[0]) / base[0],
+                        cycles,
+                        100 * (cycles - base[1]) / base[1] if base[1] else 0,
+                        "" if passed else "!",
+                    )
+                )
+            print("{:20}".format(os.path.basename(directory)) + "".join(cells))
+    print("(ROM words and cycles to halt; ! marks a result that fails its .cmp)")
+
+
+def optimization(dirs):
+    """VM commands and cycles to halt of every directory as written and
+    through the Optimizer."""
+    print(
+        "{:20} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "", "commands", "after", "cycles", "after", "saved"
+        )
+    )
+    total = [0, 0, 0, 0]
+    with tempfile.TemporaryDirectory() as tmp:
+        fout = os.path.join(tmp, "out.asm")
+        for directory in dirs:
+            row = []
+            passed = True
+            optimizer = translator.Optimizer()
+            for x in (None, optimizer):
+                translate_dir(directory, translator.CodeWriter, fout, optimizer=x)
+                with open(fout, "r") as f:
+                    cycles, ok = execute(assembler.assemble(f), directory)
+                row.append(cycles)
+                passed = passed and ok
+            row = [optimizer.seen, optimizer.kept] + row
+            total = [a + b for a, b in zip(total, row)]
+            print(
+                "{:20} {:>8} {:>8} {:>8} {:>8} {:7.1f}%{}".format(
+                    os.path.basename(directory),
+                    *row,
+                    100 * (row[2] - row[3]) / row[2],
+                    "" if passed else " !",
+                )
+            )
+    print(
+        "{:20} {:>8} {:>8} {:>8} {:>8} {:7.1f}%".format(
+            "total", *total, 100 * (total[2] - total[3]) / total[2]
+        )
+    )
+    print("(! marks a result that fails its .cmp)")
+
+
+def game_loop(directory, size, loop, cycles):
+    """Run a game `cycles` instructions long in the profiler, built with the
+    functions of up to `size` commands inlined (none if size is 0). Returns
+    the ROM words and the instructions per iteration of its loop, the
+    function `loop`, which waits once per iteration; the time in Sys.wait
+    is left out."""
+    files = sorted(glob.glob(os.path.join(directory, "*.vm")))
+    programs = [vmparser.Program.from_file(x) for x in files]
+    if size:
+        programs = translator.Inliner(size).run(programs)
+    # pruned and stack-cached, so that a whole game fits in ROM
+    writer = translator.StackCacheWriter(None, len(files) > 1)
+    keep = translator.live_functions(programs, writer.multiple)
+    for program in programs:
+        translator.translate_program(program, writer, keep)
+    if writer.multiple:
+        writer.writeMain()
+    encoder = translator.RomEncoder()
+    words = encoder.encode(writer.finish())
+    hack = profiler.ProfiledHack(
+        words, profiler.probe_table(writer.probes, encoder.labels)
+    )
+    hack.run(cycles)
+    hack.profile.finish(hack.cycles)
+    profile = hack.profile
+    iterations = profile.calls.get("Sys.wait", 0)
+    if not iterations or loop not in profile.inclusive:
+        return len(words), None
+    waiting = profile.inclusive["Sys.wait"]
+    return len(words), (profile.inclusive[loop] - waiting) / iterations
+
+
+def inlining(dirs, size, loop, cycles):
+    print(
+        "{:20} {:>8} {:>8} {:>10} {:>10} {:>7}".format(
+            "", "ROM", "inlined", "per loop", "inlined", "saved"
+        )
+    )
+    for directory in dirs:
+        rom, before = game_loop(directory, 0, loop, cycles)
+        inlinedRom, after = game_loop(directory, size, loop, cycles)
+        if before is None or after is None:
+            print("{:20} {} never waits".format(directory, loop))
+            continue
+        print(
+            "{:20} {:>8} {:>8} {:>10.0f} {:>10.0f} {:6.1f}%".format(
+                os.path.basename(os.path.normpath(directory)),
+                rom,
+                inlinedRom,
+                before,
+                after,
+                100 * (before - after) / before,
+            )
+        )
+    print("(instructions per iteration of {}, Sys.wait left out)".format(loop))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VM translator")
+    parser.add_argument(
+        "dirs",
+        nargs="*",
+        help="(optional) directories of .vm files, defaults to the 08 tests",
+    )
+    parser.add_argument("-n", type=int, default=20, help="repetitions, best is kept")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="compare ROM size and executed cycles of inline and compact code",
+    )
+    parser.add_argument(
+        "--stack-cache",
+        action="store_true",
+        help="compare ROM size and executed cycles of inline and stack-cached code",
+    )
+    parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="compare VM commands and executed cycles with and without the "
+        "Optimizer",
+    )
+    parser.add_argument(
+        "--inline",
+        type=int,
+        metavar="SIZE",
+        help="compare ROM size and instructions per game loop iteration "
+        "without and with inlining the functions of up to SIZE commands",
+    )
+    parser.add_argument(
+        "--loop",
+        default="SquareGame.run",
+        help="with --inline, the function of the game loop, which calls "
+        "Sys.wait, directly or not, once per iteration",
+    )
+    parser.add_argument(
+        "--cycles",
+        type=int,
+        default=10_000_000,
+        help="with --inline, instructions to run each game for",
+    )
+    parser.add_argument(
+        "--parse",
+        action="store_true",
+        help="compare parse speed and memory of the Parser and the Program IR",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="compare serial translation with translation in this many processes",
+    )
+    parser.add_argument(
+        "--build",
+        action="store_true",
+        help="compare .vm to .hack build time through assembly and direct",
+    )
+    parser.add_argument(
+        "--vm",
+        type=int,
+        metavar="STEPS",
+        help="run the directories in the VM emulator, for at most this many "
+        "commands each, and report commands/s",
+    )
+    parser.add_argument(
+        "--native",
+        metavar="FUNCTION",
+        help="with --vm, compare the OS run as VM code and as native code up "
+        "to the first call of FUNCTION",
+    )
+    args = parser.parse_args()
+    dirs = args.dirs or sorted(
+        glob.glob(os.path.join(here, "FunctionCalls", "*"))
+        + glob.glob(os.path.join(here, "ProgramFlow", "*"))
+    )
+
+    if args.parse:
+        parse(dirs, args.n)
+        return
+    if args.optimize:
+        optimization(dirs)
+        return
+    if args.inline:
+        inlining(dirs, args.inline, args.loop, args.cycles)
+        return
+    if args.build:
+        build(dirs, args.n)
+        return
+    if args.vm and args.native:
+        run_native(dirs, args.vm, args.native)
+        return
+    if args.vm:
+        run_vm(dirs, args.vm)
+        return
+    if args.compact:
+        compare(
+            dirs,
+            {
+                "inline": translator.CodeWriter,
+                "compact": functools.partial(translator.CodeWriter, compact=True),
+            },
+        )
+        return
+    if args.stack_cache:
+        compare(
+            dirs,
+            {
+                "inline": translator.CodeWriter,
+                "stack cache": translator.StackCacheWriter,
+            },
+        )
+        return
+
+    if args.jobs:
+        with tempfile.TemporaryDirectory() as tmp:
+            fout = os.path.join(tmp, "out.asm")
+            commands, serial = measure(dirs, translator.CodeWriter, args.n, fout)
+            _, parallel = measure(
+                dirs, translator.CodeWriter, args.n, fout, args.jobs
+            )
+        print("{} directories, {} VM commands".format(len(dirs), commands))
+        print("serial    {:10.0f} commands/s".format(commands / serial))
+        print("{} jobs {:13.0f} commands/s".format(args.jobs, commands / parallel))
+        print("speedup   {:10.2f}x".format(serial / parallel))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fout = os.path.join(tmp, "out.asm")
+        commands, printed = measure(dirs, PrintWriter, args.n, fout)
+        _, buffered = measure(dirs, translator.CodeWriter, args.n, fout)
+
+    print("{} directories, {} VM commands".format(len(dirs), commands))
+    print("print()   {:10.0f} commands/s".format(commands / printed))
+    print("buffered  {:10.0f} commands/s".format(commands / buffered))
+    print("speedup   {:10.2f}x".format(printed / buffered))
+
+
+if __name__ == "__main__":
+    main()
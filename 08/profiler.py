@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "06"))
+import assembler  # noqa: E402
+import emulator  # noqa: E402
+
+
+class Profile:
+    """Per-function counts, kept from the calls and returns of a run: entry
+    counts, exclusive instructions (run by the function itself) and
+    inclusive ones (run until it returned, callees included), plus the same
+    for every caller-callee arc. A recursive function's inclusive count
+    only covers its outermost activation, so nothing is counted twice."""
+
+    def __init__(self):
+        self.calls = {}
+        self.exclusive = {}
+        self.inclusive = {}
+        # (caller, callee) -> [calls, inclusive instructions]
+        self.arcs = {}
+        # (function, instruction count when it was entered)
+        self.stack = []
+        self.active = {}
+        self.mark = 0
+
+    def charge(self, now):
+        # the instructions since the last event belong to the running function
+        function = self.stack[-1][0] if self.stack else None
+        self.exclusive[function] = self.exclusive.get(function, 0) + now - self.mark
+        self.mark = now
+
+    def enter(self, function, now):
+        self.charge(now)
+        caller = self.stack[-1][0] if self.stack else None
+        self.calls[function] = self.calls.get(function, 0) + 1
+        self.arcs.setdefault((caller, function), [0, 0])[0] += 1
+        self.stack.append((function, now))
+        self.active[function] = self.active.get(function, 0) + 1
+
+    def leave(self, now):
+        if not self.stack:
+            return
+        self.charge(now)
+        function, start = self.stack.pop()
+        self.active[function] -= 1
+        if not self.active[function]:
+            caller = self.stack[-1][0] if self.stack else None
+            elapsed = now - start
+            self.inclusive[function] = self.inclusive.get(function, 0) + elapsed
+            self.arcs[caller, function][1] += elapsed
+
+    def finish(self, now):
+        # whatever is still running counts as returning at the end of the run
+        while self.stack:
+            self.leave(now)
+
+
+def probe_table(probes, labels):
+    # the probes of a writer (see CodeWriter.probes) by address, as
+    # ProfiledHack takes them; labels maps label names to addresses
+    table = {}
+    for function in probes["enter"]:
+        if function in labels:
+            table[labels[function]] = (function, False)
+    for label in probes["return"]:
+        if label in labels:
+            function = table.get(labels[label], (None,))[0]
+            table[labels[label]] = (function, True)
+    return table
+
+
+class ProfiledHack(emulator.Hack):
+    """Hack computer that reports the calls and returns of a translated
+    program to a Profile. It runs the plain interpreter loop; the probe
+    table is only looked up when a jump is taken, since that is the only
+    way into a function or back to a caller."""
+
+    def __init__(self, rom, probes):
+        super().__init__(rom)
+        # address -> (function entered there or None, whether calls return
+        # there); a function can start right at the return point of the
+        # call before it, and LCL == SP tells an entry from a return then
+        self.probes = probes
+        self.profile = Profile()
+        # LCL of the function on top of the profile's stack
+        self.frame = None
+
+    @classmethod
+    def from_file(cls, fin):
+        # the .sym and .prof files of a profiling build sit next to the ROM
+        name = assembler.read_name(fin)
+        symbols = assembler.SymbolMap.load(name + ".sym")
+        labels = {label: address for address, label in symbols.labels}
+        with open(name + ".prof", "r") as f:
+            probes = json.load(f)
+        return cls(assembler.load(fin), probe_table(probes, labels))
+
+    def run(self, cycles):
+        program = self.program
+        size = len(program)
+        ram = self.ram
+        probes = self.probes
+        profile = self.profile
+        base = self.cycles
+        A, D, pc = self.A, self.D, self.pc
+        frame = self.frame
+        n = 0
+        while n < cycles and 0 <= pc < size:
+            ins = program[pc]
+            n += 1
+            if ins.__class__ is int:
+                A = ins
+                pc += 1
+                continue
+            alu, readM, setA, setD, setM, jump = ins
+            address = A & 0x7FFF
+            out = alu(D, ram[address] if readM else A)
+            if setM:
+                ram[address] = out
+            if jump is not None and jump(out):
+                pc = A & 0x7FFF
+                probe = probes.get(pc)
+                # a jump that keeps LCL is a loop that happens to land on a
+                # probe, a call or a return always moves the frame
+                if probe is not None and ram[1] != frame:
+                    function, returns = probe
+                    if function is not None and ram[1] == ram[0]:
+                        profile.enter(function, base + n)
+                        frame = ram[1]
+                    elif returns:
+                        profile.leave(base + n)
+                        frame = ram[1]
+            else:
+                pc += 1
+            if setA:
+                A = out
+            if setD:
+                D = out
+        self.A, self.D, self.pc = A, D, pc
+        self.frame = frame
+        self.cycles += n
+        return n
+
+
+def flat_profile(profile, total, top):
+    print("Flat profile, {} instructions".format(total))
+    print(
+        "{:>7} {:>12} {:>7} {:>12} {:>9}  function".format(
+            "%self", "self", "%total", "total", "calls"
+        )
+    )
+    rows = sorted(profile.exclusive.items(), key=lambda x: -x[1])
+    for function, own in rows[:top]:
+        inclusive = profile.inclusive.get(function, own)
+        print(
+            "{:7.2f} {:>12} {:7.2f} {:>12} {:>9}  {}".format(
+                100 * own / total,
+                own,
+                100 * inclusive / total,
+                inclusive,
+                profile.calls.get(function, ""),
+                function or "(outside any function)",
+            )
+        )
+
+
+def call_graph(profile, top):
+    print("Call graph, by inclusive instructions")
+    callers = {}
+    callees = {}
+    for (caller, callee), arc in profile.arcs.items():
+        callers.setdefault(callee, []).append((caller, arc))
+        callees.setdefault(caller, []).append((callee, arc))
+    rows = sorted(profile.inclusive.items(), key=lambda x: -x[1])
+    for function, inclusive in rows[:top]:
+        print("-" * 60)
+        for caller, (calls, total) in sorted(callers.get(function, ()), key=str):
+            print("    {:>9} {:>12}  from {}".format(calls, total, caller or "(start)"))
+        print(
+            "{}  calls {}  self {}  total {}".format(
+                function,
+                profile.calls.get(function, 0),
+                profile.exclusive.get(function, 0),
+                inclusive,
+            )
+        )
+        for callee, (calls, total) in sorted(callees.get(function, ()), key=str):
+            print("    {:>9} {:>12}  to {}".format(calls, total, callee))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Profile a translated VM program per function"
+    )
+    parser.add_argument(
+        "fin",
+        help="the program (.hack or .bin) of a build made with translator.py "
+        "--profile; its .prof and .sym files are read from next to it",
+    )
+    parser.add_argument(
+        "-n",
+        "--cycles",
+        type=int,
+        default=10_000_000,
+        help="(optional) number of instructions to execute",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="(optional) functions to list"
+    )
+    args = parser.parse_args()
+
+    hack = ProfiledHack.from_file(args.fin)
+    n = hack.run(args.cycles)
+    hack.profile.finish(hack.cycles)
+    flat_profile(hack.profile, n, args.top)
+    print()
+    call_graph(hack.profile, args.top)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,333 @@
 import argparse
+import json
 import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from array import array
 
+from vmparser import (
+    PUSH,
+    POP,
+    ADD,
+    SUB,
+    NEG,
+    EQ,
+    GT,
+    LT,
+    AND,
+    OR,
+    NOT,
+    LABEL,
+    GOTO,
+    IF,
+    FUNCTION,
+    CALL,
+    RETURN,
+    Program,
+    opcodeNames,
+)
 
-class Parser:
-    commandTypeTable = {
-        "label": "C_LABEL",
-        "function": "C_FUNCTION",
-        "push": "C_PUSH",
-        "pop": "C_POP",
-        "goto": "C_GOTO",
-        "if-goto": "C_IF",
-        "return": "C_RETURN",
-        "call": "C_CALL",
-        "add": "C_ARITHMETIC",
-        "sub": "C_ARITHMETIC",
-        "neg": "C_ARITHMETIC",
-        "eq": "C_ARITHMETIC",
-        "gt": "C_ARITHMETIC",
-        "lt": "C_ARITHMETIC",
-        "and": "C_ARITHMETIC",
-        "or": "C_ARITHMETIC",
-        "not": "C_ARITHMETIC",
-    }
+# part of every fragment cache key; bump whenever the code of any command
+# changes
+VERSION = "3"
 
-    def __init__(self, fd):
-        self.file = fd.readlines()
-        self.file = [Parser.modifyLine(x) for x in self.file]
-        self.file = list(filter(lambda x: x != "", self.file))
-        self.file_length = len(self.file)
 
-        self.index = -1
-        self.command = ""
-        self.command_type = self.arg_1 = self.arg_2 = ""
+def wrap(value):
+    # value as a signed 16-bit word
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
 
-    def hasMoreCommands(self):
-        return self.index < self.file_length - 1
 
-    def advance(self):
-        self.index += 1
-        line = self.file[self.index].split(" ")
-        self.command = line[0]
-        self.command_type = Parser.commandTypeTable[line[0]]
-        try:
-            self.arg_1 = line[1]
-            self.arg_2 = line[2]
-        except:
-            pass
+# what the arithmetic commands compute, before wrapping to 16 bits; gt and lt
+# test the sign of the wrapped x - y, as the written code does, so that a
+# subtraction that overflows folds to what the program would compute
+unaryFolding = {NEG: lambda x: -x, NOT: lambda x: ~x}
+binaryFolding = {
+    ADD: lambda x, y: x + y,
+    SUB: lambda x, y: x - y,
+    EQ: lambda x, y: -(x == y),
+    GT: lambda x, y: -(wrap(x - y) > 0),
+    LT: lambda x, y: -(wrap(x - y) < 0),
+    AND: lambda x, y: x & y,
+    OR: lambda x, y: x | y,
+}
+
+
+def doubling(scratch):
+    # x + x, for a multiplication by a power of two, through a static of the
+    # file that its code never uses: a temp can hold a value of any function
+    # up the call stack, the statics of a file are its own
+    return [
+        (POP, "static", scratch),
+        (PUSH, "static", scratch),
+        (PUSH, "static", scratch),
+        (ADD, "", 0),
+    ]
+
 
-    def commandType(self):
-        return self.command_type
+class Optimizer:
+    """Optional pass over a Program before it is written. Rewrites the tail
+    of the command stream as it grows, never across a label or a function:
+      push constant a / push constant b / add   -> push constant a+b
+        (and the same for every other arithmetic or logic command)
+      push constant a / neg or not             -> the result
+      x / push constant 2^k / call Math.multiply 2  -> x doubled k times
+      push constant 2^k / push s i / call Math.multiply 2
+                                               -> push s i doubled k times
+      push s i / pop s i                       -> gone
+    A result outside the range of push constant is pushed as the neg or the
+    not of one, and a folding is only made when it is shorter. Doublings go
+    through the first static index the file leaves unused."""
 
-    def arg1(self):
-        assert self.command_type != "C_RETURN"
-        if self.command_type == "C_ARITHMETIC":
-            return self.command
-        return self.arg_1
+    def __init__(self):
+        self.seen = 0
+        self.kept = 0
+        self.multiplications = 0
+        self.start = 0
+        # the static doublings go through
+        self.scratch = 0
 
-    def arg2(self):
-        assert self.command_type in ("C_PUSH", "C_POP", "C_FUNCTION", "C_CALL")
-        return int(self.arg_2)
+    @property
+    def removed(self):
+        return self.seen - self.kept
 
-    def modifyLine(line):
-        line = line[:-1]
-        i = line.find("//")
-        if i != -1:
-            line = line[:i]
+    @staticmethod
+    def constant(value):
+        # the commands pushing a value, wrapped to 16 bits
+        value = wrap(value)
+        if value >= 0:
+            return [(PUSH, "constant", value)]
+        if value == -0x8000:
+            return [(PUSH, "constant", 0x7FFF), (NOT, "", 0)]
+        return [(PUSH, "constant", -value), (NEG, "", 0)]
 
-        line = line.replace("\t", "").strip()
-        return line
+    def value(self, out, end):
+        # (value, start) when out[start:end] pushes a constant, else None
+        if end <= self.start:
+            return None
+        op, name, value = out[end - 1]
+        if op == PUSH and name == "constant":
+            return value, end - 1
+        if op in unaryFolding and end - 1 > self.start:
+            op2, name, value = out[end - 2]
+            if op2 == PUSH and name == "constant":
+                return unaryFolding[op](value), end - 2
+        return None
+
+    def rewrite(self, out):
+        # apply one rule to the tail of out, False if none matches
+        op, name, value = out[-1]
+        end = len(out) - 1
+        if op in unaryFolding:
+            x = self.value(out, end)
+            if x is None:
+                return False
+            replacement, start = self.constant(unaryFolding[op](x[0])), x[1]
+        elif op in binaryFolding:
+            y = self.value(out, end)
+            x = y and self.value(out, y[1])
+            if x is None:
+                return False
+            replacement = self.constant(binaryFolding[op](x[0], y[0]))
+            start = x[1]
+        elif op == CALL and name == "Math.multiply" and value == 2:
+            y = self.value(out, end)
+            x = y and self.value(out, y[1])
+            if x is not None:
+                replacement, start = self.constant(x[0] * y[0]), x[1]
+            else:
+                if y is not None:
+                    # any operand under the constant, it only gets doubled
+                    operand, start = [], y[1]
+                elif end > self.start and out[end - 1][0] == PUSH:
+                    # the constant first: the other operand has to be a
+                    # single push for the constant to be taken from under it
+                    y = self.value(out, end - 1)
+                    if y is None:
+                        return False
+                    operand, start = [out[end - 1]], y[1]
+                else:
+                    return False
+                power = y[0]
+                if power <= 0 or power & (power - 1):
+                    return False
+                # longer than the call, but a fraction of its cycles
+                steps = power.bit_length() - 1
+                out[start:] = operand + doubling(self.scratch) * steps
+                self.multiplications += 1
+                return True
+        elif op == POP and end > self.start and out[end - 1] == (PUSH, name, value):
+            replacement, start = [], end - 1
+        else:
+            return False
+        if len(replacement) >= len(out) - start:
+            return False
+        out[start:] = replacement
+        return True
+
+    def run(self, program):
+        # a copy of program with the rewrites applied
+        out = []
+        lines = []
+        self.start = 0
+        self.scratch = 1 + max(
+            (x[2] for x in program if x[0] <= POP and x[1] == "static"), default=-1
+        )
+        for command, line in zip(program, program.positions):
+            out.append(command)
+            if command[0] == LABEL or command[0] == FUNCTION:
+                self.start = len(out)
+            while len(out) > self.start and self.rewrite(out):
+                pass
+            # what a rewrite leaves in place keeps its line, what it adds
+            # gets the line of the command that set it off
+            del lines[len(out) :]
+            lines += [line] * (len(out) - len(lines))
+        self.seen += len(program)
+        self.kept += len(out)
+        optimized = Program(program.filename)
+        for command, line in zip(out, lines):
+            optimized.append(*command, line)
+        return optimized
+
+
+class Inliner:
+    """Whole-program pass that replaces the calls of small functions by their
+    code. A function is inlined when it has at most `size` commands besides
+    its return, calls nothing, has no labels or jumps and returns with just
+    its result on the stack, as the getters and setters the Jack compiler
+    writes do. It runs in rounds, so that a function whose own calls were
+    all inlined can be inlined in turn.
+
+    The arguments and locals of an inlined call are popped into temps above
+    every temp that the caller or the inlined code uses, and the pointers it
+    sets are saved there too and put back afterwards, as its return would;
+    a call is left alone when the temps run out. Its statics stay those of
+    its own file: from another file they are written as the segment
+    static.File, which the writers and the VM emulator resolve to the
+    statics of File. That segment only exists in the Programs the Inliner
+    makes; the parser rejects it in a .vm file."""
+
+    def __init__(self, size):
+        self.size = size
+        self.inlined = 0
+        self.functions = set()
+
+    @staticmethod
+    def split(program):
+        # (name, number of locals, commands) of every function of program
+        function = None
+        for command in program:
+            if command[0] == FUNCTION:
+                if function is not None:
+                    yield function
+                function = (command[1], command[2], [])
+            elif function is not None:
+                function[2].append(command)
+        if function is not None:
+            yield function
+
+    def shape(self, body):
+        # (pointers it sets, temps it uses) of an inlinable body, else None
+        if not body or len(body) - 1 > self.size or body[-1][0] != RETURN:
+            return None
+        depth = 0
+        pointers = set()
+        temps = 0
+        for op, name, value in body[:-1]:
+            if op > NOT:
+                return None
+            if op == PUSH:
+                depth += 1
+            elif op == NEG or op == NOT:
+                if depth < 1:
+                    return None
+            else:
+                if depth < (1 if op == POP else 2):
+                    return None
+                depth -= 1
+            if op == POP and name == "pointer":
+                pointers.add(value)
+            if op <= POP and name == "temp":
+                temps = max(temps, value + 1)
+        if depth != 1:
+            return None
+        return sorted(pointers), temps
+
+    @staticmethod
+    def temps(program):
+        # function name -> number of temps its code uses, counting from
+        # temp 0; None stands for the commands before the first function
+        used = {}
+        function = None
+        for op, name, value in program:
+            if op == FUNCTION:
+                function = name
+            elif op <= POP and name == "temp":
+                used[function] = max(used.get(function, 0), value + 1)
+        return used
+
+    def expand(self, callee, argc, filename, callerTemps, out, line):
+        # append the code of an inlined call to out; False if it does not fit
+        calleeFile, nLocals, body, pointers, temps = callee
+        base = max(temps, callerTemps)
+        saved = base + argc + nLocals
+        if saved + len(pointers) > 8:
+            return False
+        slot = {"argument": base, "local": base + argc}
+        for op, name, value in body:
+            if name == "argument" and value >= argc:
+                return False
+        static = "static" if calleeFile == filename else "static." + calleeFile
+        code = [(POP, "temp", base + i) for i in reversed(range(argc))]
+        for i in range(nLocals):
+            code += [(PUSH, "constant", 0), (POP, "temp", slot["local"] + i)]
+        for i, pointer in enumerate(pointers):
+            code += [(PUSH, "pointer", pointer), (POP, "temp", saved + i)]
+        for op, name, value in body[:-1]:
+            if op <= POP and name in slot:
+                name, value = "temp", slot[name] + value
+            elif op <= POP and name == "static":
+                name = static
+            code.append((op, name, value))
+        for i, pointer in enumerate(pointers):
+            code += [(PUSH, "temp", saved + i), (POP, "pointer", pointer)]
+        for command in code:
+            out.append(*command, line)
+        return True
+
+    def inline(self, program, leaves):
+        filename = read_name(os.path.basename(program.filename))
+        out = Program(program.filename)
+        used = self.temps(program)
+        function = None
+        for (op, name, value), line in zip(program, program.positions):
+            if op == FUNCTION:
+                function = name
+            callee = leaves.get(name) if op == CALL else None
+            if callee is not None and self.expand(
+                callee, value, filename, used.get(function, 0), out, line
+            ):
+                self.inlined += 1
+                self.functions.add(name)
+            else:
+                out.append(op, name, value, line)
+        return out
+
+    def run(self, programs):
+        # the programs with the calls of small functions inlined
+        while True:
+            leaves = {}
+            for program in programs:
+                filename = read_name(os.path.basename(program.filename))
+                for name, nLocals, body in self.split(program):
+                    shape = self.shape(body)
+                    if shape is not None:
+                        leaves[name] = (filename, nLocals, body) + shape
+            inlined = self.inlined
+            programs = [self.inline(x, leaves) for x in programs]
+            if self.inlined == inlined:
+                return programs
 
 
 str1 = """@SP
@@ -100,6 +360,79 @@ A=M-1
 M=D
 """
 
+# shared routines of the compact mode; every call site stores its return
+# address (and for $$CALL the argument count in R13 and the callee in R14)
+# and jumps in, instead of inlining the whole sequence
+callRoutine = """($$CALL)
+@SP
+A=M
+M=D
+@SP
+M=M+1
+{}@SP
+D=M
+@R13
+D=D-M
+@5
+D=D-A
+@ARG
+M=D
+@SP
+D=M
+@LCL
+M=D
+@R14
+A=M
+0;JMP
+"""
+compareRoutine = """($$EQ)
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+@$$TRUE
+D;JEQ
+@$$FALSE
+0;JMP
+($$GT)
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+@$$TRUE
+D;JGT
+@$$FALSE
+0;JMP
+($$LT)
+@SP
+AM=M-1
+D=M
+A=A-1
+D=M-D
+@$$TRUE
+D;JLT
+($$FALSE)
+@SP
+A=M-1
+M=0
+@R13
+A=M
+0;JMP
+($$TRUE)
+@SP
+A=M-1
+M=-1
+@R13
+A=M
+0;JMP
+"""
+haltLoop = """($$HALT)
+@$$HALT
+0;JMP
+"""
+
 
 class CodeWriter:
 
@@ -117,45 +450,97 @@ class CodeWriter:
 
     seg_table = {"local": "LCL", "argument": "ARG", "this": "THIS", "that": "THAT"}
 
-    def __init__(self, file, isdir):
-        self.file = open(file, "w")
+    def __init__(self, file, isdir, compact=False):
+        # the generated code is collected in memory and written out in one
+        # go by close()
+        self.file = file
+        self.buffer = []
         self.index = 0
+        # appended to generated labels; translate_parallel() gives every file
+        # its own so that fragments translated apart can be linked together
+        self.scope = ""
+        # compact mode jumps into shared call/return/compare routines,
+        # which are appended by close() if anything used them
+        self.compact = compact
+        self.routines = set()
         self.functionName = ""
         self.return_dict = dict()
         self.multiple = isdir
         self.hasMain = False
         self.mainFunc = ""
+        # labels of the function entries and of the points calls return
+        # to, which is all a profiler needs to follow the calls
+        self.probes = {"enter": [], "return": []}
         if isdir:
             self.writeInit()
 
     def setFileName(self, filename):
         self.filename = filename
 
+    def emit(self, st):
+        self.buffer.append(st)
+
+    def writeRoutines(self):
+        if not self.routines:
+            return
+        # the program may run off its end, so keep it out of the routines
+        self.emit(haltLoop)
+        if "call" in self.routines:
+            pushes = "".join(self._pushSign(x) for x in ("LCL", "ARG", "THIS", "THAT"))
+            self.emit(callRoutine.format(pushes))
+        if "return" in self.routines:
+            self.emit("($$RETURN)\n" + self._returnCode())
+        if "compare" in self.routines:
+            self.emit(compareRoutine)
+        self.routines = set()
+
+    def _tag(self):
+        # a fresh suffix for the labels of one compare
+        tag = self.scope + str(self.index)
+        self.index += 1
+        return tag
+
+    def fragment(self):
+        # the code written so far, leaving the routines to the linker
+        text = "".join(self.buffer)
+        self.buffer = []
+        return text
+
+    def finish(self):
+        # the whole program as the pieces of code emitted, routines included
+        self.writeRoutines()
+        snippets = self.buffer
+        self.buffer = []
+        return snippets
+
     def close(self):
-        self.file.close()
+        text = "".join(self.finish())
+        with open(self.file, "w") as f:
+            f.write(text)
 
     def writeInit(self):
         st = ""
         st += "@256\nD=A\n@SP\nM=D\n"
-        print(st, file=self.file)
+        self.emit(st)
         self.writeCall("Sys.init", 0)
 
     def writeMain(self):
         if not self.hasMain:
             st = "(Sys.init)\n"
-            print(st, file=self.file)
+            self.emit(st)
+            self.probes["enter"].append("Sys.init")
             self.writeCall(self.mainFunc, 0)
 
     def writeLabel(self, label):
         label = "(" + self.functionName + "$" + label + ")\n"
-        print(label, file=self.file)
+        self.emit(label)
 
     def writeGoto(self, label):
-        print("@" + self.functionName + "$" + label + "\n0;JMP\n", file=self.file)
+        self.emit("@" + self.functionName + "$" + label + "\n0;JMP\n")
 
     def writeIf(self, label):
         st = "@SP\nAM=M-1\nD=M\n@" + self.functionName + "$" + label + "\nD;JNE\n"
-        print(st, file=self.file)
+        self.emit(st)
 
     def _pushSign(self, x):
         return "@" + str(x) + "\nD=M\n@SP\nA=M\nM=D\n@SP\nM=M+1\n"
@@ -164,7 +549,16 @@ class CodeWriter:
         ret = self.functionName + "$return-address"
         self.return_dict.setdefault(ret, 0)
         self.return_dict[ret] += 1
-        ret = ret + str(self.return_dict[ret])
+        ret = ret + self.scope + str(self.return_dict[ret])
+        self.probes["return"].append(ret)
+        if self.compact:
+            self.routines.add("call")
+            st = "@" + str(argc) + "\nD=A\n@R13\nM=D\n"
+            st += "@" + func + "\nD=A\n@R14\nM=D\n"
+            st += "@" + ret + "\nD=A\n@$$CALL\n0;JMP\n"
+            st += "(" + ret + ")\n"
+            self.emit(st)
+            return
         st = (
             "@"
             + str(ret)
@@ -180,9 +574,16 @@ class CodeWriter:
         st += "@SP\nD=M\n@LCL\nM=D\n"  # LCL=SP
         st += "@" + func + "\n0;JMP\n"  # goto func
         st += "(" + ret + ")\n"
-        print(st, file=self.file)
+        self.emit(st)
 
     def writeReturn(self):
+        if self.compact:
+            self.routines.add("return")
+            self.emit("@$$RETURN\n0;JMP\n")
+        else:
+            self.emit(self._returnCode())
+
+    def _returnCode(self):
         callFrame = "@R13\nD=M\n@{}\nA=D-A\nD=M\n@{}\nM=D\n"
         st = "@LCL\nD=M\n@R13\nM=D\n"
         st += callFrame.format(5, "R14")
@@ -193,17 +594,18 @@ class CodeWriter:
         st += callFrame.format(3, "ARG")
         st += callFrame.format(4, "LCL")
         st += "@R14\nA=M\n0;JMP\n"
-        print(st, file=self.file)
+        return st
 
     def writeFunc(self, func, nLocals):
         self.functionName = func
+        self.probes["enter"].append(func)
         if func == "Sys.init":
             self.hasMain = True
         else:
             self.mainFunc = func
         st = "(" + func + ")\n"
         st += self._PushPop("push", "constant", 0) * nLocals
-        print(st, file=self.file)
+        self.emit(st)
 
     def writeArithmetic(self, cmd):
         st = ""
@@ -211,11 +613,15 @@ class CodeWriter:
             st = str1.replace("$", CodeWriter.opr_table[cmd])
         if cmd in ("not", "neg"):
             st = str2.replace("$", CodeWriter.opr_table[cmd])
-        if cmd in ("eq", "gt", "lt"):
+        if cmd in ("eq", "gt", "lt") and self.compact:
+            self.routines.add("compare")
+            ret = "CMP" + self._tag()
+            st = "@" + ret + "\nD=A\n@R13\nM=D\n"
+            st += "@$$" + cmd.upper() + "\n0;JMP\n(" + ret + ")\n"
+        elif cmd in ("eq", "gt", "lt"):
             st = str3.replace("$", CodeWriter.opr_table[cmd])
-            st = st.replace("#", str(self.index))
-            self.index += 1
-        print(st, file=self.file)
+            st = st.replace("#", self._tag())
+        self.emit(st)
 
     def _load_address(self, seg, ind):
         # load the address of some place in register A
@@ -228,6 +634,9 @@ class CodeWriter:
             return "@" + str(ind + 5) + "\n"
         if seg == "static":
             return "@" + self.filename + "." + str(ind) + "\n"
+        if seg.startswith("static."):
+            # the statics of another file, in code the Inliner moved here
+            return "@" + seg[7:] + "." + str(ind) + "\n"
 
     def _PushPop(self, cmd, seg, ind):
         st = ""
@@ -244,7 +653,290 @@ class CodeWriter:
 
     def writePushPop(self, cmd, seg, ind):
         st = self._PushPop(cmd, seg, ind)
-        print(st, file=self.file)
+        self.emit(st)
+
+
+class StackCacheWriter(CodeWriter):
+    """CodeWriter that keeps the top of the stack in D between VM commands of
+    a basic block instead of storing it at SP and loading it back. It also
+    holds back the last push of a constant or of a memory cell, and the
+    result of the last comparison, so that the next command can use them
+    directly: `push constant N; add` becomes `@N; D=D+A`, and `lt; if-goto L`
+    becomes a subtraction and a single `D;JLT`. Everything is written back to
+    the stack before labels, jumps, calls and returns, so jump targets always
+    see the plain stack layout."""
+
+    binary_table = {"add": "D+{}", "sub": "D-{}", "and": "D&{}", "or": "D|{}"}
+
+    def __init__(self, file, isdir, compact=False):
+        # True when the top of the stack lives in D instead of RAM[SP]
+        self.cached = False
+        # a push not emitted yet: ("A", code) for a constant loaded by code,
+        # ("M", code) for the memory cell code points A at
+        self.pending = None
+        # jump condition on D = x - y of a comparison not materialized yet
+        self.compare = None
+        super().__init__(file, isdir, compact)
+
+    def _operand(self, seg, ind):
+        # code that points A at a cell using A alone (D is busy), or None
+        if seg in ("local", "argument", "this", "that"):
+            if ind > 6:
+                return None
+            return "@" + CodeWriter.seg_table[seg] + "\nA=M\n" + "A=A+1\n" * ind
+        if seg == "constant":
+            return None
+        return self._load_address(seg, ind)
+
+    def _spill(self):
+        # push D onto the RAM stack
+        if self.cached:
+            self.emit("@SP\nA=M\nM=D\n@SP\nM=M+1\n")
+            self.cached = False
+
+    def _top(self):
+        # make D hold the top of the stack, whatever is pending
+        if self.compare is not None:
+            st = "@TRUE#\nD;$\nD=0\n@END#\n0;JMP\n(TRUE#)\nD=-1\n(END#)\n"
+            st = st.replace("$", self.compare).replace("#", self._tag())
+            self.emit(st)
+            self.compare = None
+        elif self.pending is not None:
+            self._spill()
+            kind, code = self.pending
+            self.emit(code + "D=" + kind + "\n")
+            self.pending = None
+        elif not self.cached:
+            self.emit("@SP\nAM=M-1\nD=M\n")
+        self.cached = True
+
+    def flush(self):
+        # back to the plain layout: everything on the RAM stack
+        if self.compare is not None or self.pending is not None:
+            self._top()
+        self._spill()
+
+    def fragment(self):
+        self.flush()
+        return super().fragment()
+
+    def finish(self):
+        self.flush()
+        return super().finish()
+
+    def writeMain(self):
+        self.flush()
+        super().writeMain()
+
+    def writeLabel(self, label):
+        self.flush()
+        super().writeLabel(label)
+
+    def writeGoto(self, label):
+        self.flush()
+        super().writeGoto(label)
+
+    def writeIf(self, label):
+        target = "@" + self.functionName + "$" + label + "\n"
+        if self.compare is not None:
+            self.emit(target + "D;" + self.compare + "\n")
+            self.compare = None
+        else:
+            self._top()
+            self.emit(target + "D;JNE\n")
+        self.cached = False
+        self.flush()
+
+    def writeCall(self, func, argc):
+        self.flush()
+        super().writeCall(func, argc)
+
+    def writeReturn(self):
+        self.flush()
+        super().writeReturn()
+
+    def writeFunc(self, func, nLocals):
+        self.flush()
+        super().writeFunc(func, nLocals)
+
+    def writeArithmetic(self, cmd):
+        if cmd in ("not", "neg"):
+            self._top()
+            self.emit("D=" + CodeWriter.opr_table[cmd] + "D\n")
+            return
+        if self.pending is not None:
+            # y is the held-back push, x is the top of the stack
+            kind, code = self.pending
+            self.pending = None
+            self._top()
+            y = kind
+            self.emit(code)
+        else:
+            # y is the top of the stack, x the cell below it
+            self._top()
+            self.emit("@SP\nAM=M-1\n")
+            y = "M"
+            if cmd in ("sub", "eq", "gt", "lt"):
+                # x - y with x in M and y in D
+                self.emit("D=M-D\n")
+                if cmd == "sub":
+                    return
+                self.compare = CodeWriter.opr_table[cmd]
+                self.cached = False
+                return
+        if cmd in ("eq", "gt", "lt"):
+            self.emit("D=D-" + y + "\n")
+            self.compare = CodeWriter.opr_table[cmd]
+            self.cached = False
+        else:
+            self.emit("D=" + StackCacheWriter.binary_table[cmd].format(y) + "\n")
+
+    def writePushPop(self, cmd, seg, ind):
+        if cmd == "push":
+            if seg == "constant":
+                operand = ("A", "@" + str(ind) + "\n")
+            else:
+                code = self._operand(seg, ind)
+                operand = None if code is None else ("M", code)
+            if self.compare is not None or self.pending is not None:
+                self._top()
+            if operand is None:
+                self._spill()
+                self.emit(self._load_address(seg, ind) + "D=M\n")
+                self.cached = True
+            else:
+                self.pending = operand
+            return
+        self._top()
+        code = self._operand(seg, ind)
+        if code is None:
+            # park the value while D computes the address
+            st = "@R13\nM=D\n@" + str(ind) + "\nD=A\n@"
+            st += CodeWriter.seg_table[seg] + "\nD=D+M\n@R14\nM=D\n"
+            st += "@R13\nD=M\n@R14\nA=M\nM=D\n"
+            self.emit(st)
+        else:
+            self.emit(code + "M=D\n")
+        self.cached = False
+
+
+def load_assembler():
+    # the ROM backend encodes with the tables of the 06 assembler
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "06")
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    import assembler
+
+    return assembler
+
+
+class RomEncoder:
+    """Encodes the code a CodeWriter emitted straight to ROM words, without
+    writing the assembly out and parsing it back. The writers emit the same
+    few pieces of code over and over, so every distinct piece is split into
+    instructions once: C-instructions and A-instructions of numbers or
+    predefined symbols become their words, other A-instructions keep their
+    symbol and labels become definitions. Labels are bound as they are met
+    and forward references patched at the end; what is still unbound is a
+    variable, given an address in order of first reference as the assembler
+    does, so the ROM is the same as assembling the .asm file."""
+
+    def __init__(self):
+        self.assembler = load_assembler()
+        # only ever asked about predefined symbols, R0-R15 included
+        self.predefined = self.assembler.Assembler().readsym
+        self.pieces = {}
+
+    def split(self, st):
+        assembler = self.assembler
+        code = []
+        for line in st.split("\n"):
+            if not line:
+                continue
+            if line[0] == "(":
+                code.append((line[1:-1],))
+            elif line[0] != "@":
+                code.append(assembler.translate_C_command(line))
+            elif line[1:].isdigit():
+                code.append(int(line[1:]))
+            else:
+                address = self.predefined(line[1:])
+                code.append(line[1:] if address is None else address)
+        return tuple(code)
+
+    def encode(self, snippets):
+        words = array("H")
+        append = words.append
+        labels = {}
+        backpatch = {}
+        pieces = self.pieces
+        for st in snippets:
+            code = pieces.get(st)
+            if code is None:
+                code = pieces[st] = self.split(st)
+            for item in code:
+                kind = item.__class__
+                if kind is int:
+                    append(item)
+                elif kind is str:
+                    address = labels.get(item)
+                    if address is None:
+                        where = backpatch.get(item)
+                        if where is None:
+                            where = backpatch[item] = array("L")
+                        where.append(len(words))
+                        address = 0
+                    append(address)
+                else:
+                    if item[0] in labels:
+                        raise SyntaxError("label {} is defined twice".format(item[0]))
+                    labels[item[0]] = len(words)
+        variable = self.assembler.VAR_BASE
+        variables = {}
+        for name, where in backpatch.items():
+            address = labels.get(name)
+            if address is None:
+                address = variables[name] = variable
+                variable += 1
+            for i in where:
+                words[i] = address
+        self.labels = labels
+        self.variables = variables
+        return words
+
+
+def write_rom(writer, fmt="text", keep_asm=False, symbols=False):
+    """Close `writer` by encoding its program to a ROM next to its .asm
+    file: a .hack for fmt "text", a packed .bin for "binary". The assembly
+    is only written too when keep_asm is set, and a .sym symbol map like
+    the assembler's (without source lines) when symbols is. Returns the
+    words."""
+    assembler = load_assembler()
+    snippets = writer.finish()
+    if keep_asm:
+        with open(writer.file, "w") as f:
+            f.write("".join(snippets))
+    encoder = RomEncoder()
+    words = encoder.encode(snippets)
+    ext, render, _ = assembler.outputFormat[fmt]
+    with assembler.atomic_open(read_name(writer.file) + ext, "wb") as f:
+        f.write(render(words))
+    if symbols:
+        index = {
+            "labels": sorted((a, name) for name, a in encoder.labels.items()),
+            "variables": sorted((a, name) for name, a in encoder.variables.items()),
+            "lines": [],
+        }
+        with assembler.atomic_open(read_name(writer.file) + ".sym", "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+    return words
+
+
+def write_probes(writer):
+    # the .prof file of a profiling build: which labels are function entries
+    # and which are return points, next to the .asm
+    with open(read_name(writer.file) + ".prof", "w") as f:
+        json.dump(writer.probes, f, separators=(",", ":"))
 
 
 def read_name(st):
@@ -261,50 +953,372 @@ def read_extension(st):
     return st[i + 1 :]
 
 
+def call_graph(programs):
+    # function name -> names of the functions it calls, over all programs;
+    # commands before the first function of a file are under ""
+    graph = {"": set()}
+    for program in programs:
+        current = ""
+        for op, name, value in program:
+            if op == FUNCTION:
+                current = name
+                graph.setdefault(name, set())
+            elif op == CALL:
+                graph[current].add(name)
+    return graph
+
+
+def live_functions(programs, bootstrap):
+    """Names of the functions reachable from where the program starts: from
+    Sys.init, or from whatever writeMain() would call in its place when
+    there is a bootstrap, or else from the first function."""
+    graph = call_graph(programs)
+    functions = [name for x in programs for op, name, _ in x if op == FUNCTION]
+    if "Sys.init" in graph:
+        roots = ["Sys.init"]
+    elif bootstrap:
+        roots = functions[-1:]
+    else:
+        roots = functions[:1]
+    live = {""}
+    stack = roots
+    while stack:
+        name = stack.pop()
+        if name not in live:
+            live.add(name)
+            stack.extend(graph.get(name, ()))
+    return live
+
+
+def rom_size(programs, filenames, writer_class, compact=False):
+    # instructions the programs translate to, labels not counted
+    writer = writer_class(None, False, compact)
+    for filename, program in zip(filenames, programs):
+        writer.setFileName(read_name(os.path.basename(filename)))
+        writeProgram(program, writer)
+    return sum(1 for x in writer.fragment().split("\n") if x and x[0] != "(")
+
+
+def translate(filename, writer, keep=None, optimizer=None):
+    return translate_program(Program.from_file(filename), writer, keep, optimizer)
+
+
+def translate_program(program, writer, keep=None, optimizer=None):
+    # translate() of a Program already in memory
+    if keep is not None:
+        program = program.select(keep)
+    if optimizer is not None:
+        program = optimizer.run(program)
+    writer.setFileName(read_name(os.path.basename(program.filename)))
+    writeProgram(program, writer)
+    return len(program)
+
+
+def writeProgram(program, writer):
+    names = program.names
+    for op, arg, value in zip(program.ops, program.args, program.values):
+        if op <= POP:
+            writer.writePushPop(opcodeNames[op], names[arg], value)
+        elif op <= NOT:
+            writer.writeArithmetic(opcodeNames[op])
+        elif op == LABEL:
+            writer.writeLabel(names[arg])
+        elif op == GOTO:
+            writer.writeGoto(names[arg])
+        elif op == IF:
+            writer.writeIf(names[arg])
+        elif op == FUNCTION:
+            writer.writeFunc(names[arg], value)
+        elif op == CALL:
+            writer.writeCall(names[arg], value)
+        else:
+            writer.writeReturn()
+
+
+def _translate_job(job):
+    # worker of translate_parallel(): one file into a writer of its own
+    filename, writer_class, compact, keep, optimizer = job
+    writer = writer_class(None, False, compact)
+    writer.scope = "$" + read_name(os.path.basename(filename)) + "."
+    commands = translate(filename, writer, keep, optimizer)
+    return (
+        writer.fragment(),
+        writer.routines,
+        writer.hasMain,
+        writer.mainFunc,
+        writer.probes,
+        commands,
+    )
+
+
+def link(writer, results):
+    # append translated files, as _translate_job() returns them, to writer
+    commands = 0
+    for text, routines, hasMain, mainFunc, probes, count in results:
+        writer.emit(text)
+        writer.routines |= routines
+        writer.hasMain = writer.hasMain or hasMain
+        writer.mainFunc = mainFunc or writer.mainFunc
+        for kind, labels in probes.items():
+            writer.probes[kind] += labels
+        commands += count
+    return commands
+
+
+def translate_parallel(filenames, writer, jobs=None, keep=None, optimizer=None):
+    """Translate every file on its own in a process pool, then link the
+    fragments into `writer` (whose bootstrap is already written) in the
+    order of `filenames`. Generated labels carry the file name, so nothing
+    collides; the output depends only on the file order. Returns the number
+    of commands translated. `keep` and `optimizer` are as in translate()."""
+    work = [(f, type(writer), writer.compact, keep, optimizer) for f in filenames]
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(_translate_job, work))
+    return link(writer, results)
+
+
+class FragmentCache:
+    """On-disk cache of translated files: what _translate_job() returns for a
+    .vm file, keyed by the content hash of the file together with its name,
+    the translator version and the writer options. The entries are kept by
+    the AssemblyCache of the 06 assembler, which does the hashing and the
+    least recently used eviction."""
+
+    def __init__(self, directory, max_bytes=64 << 20):
+        self.assembler = load_assembler()
+        self.entries = self.assembler.AssemblyCache(directory, max_bytes)
+
+    def key(self, filename, *options):
+        with open(filename, "rb") as f:
+            name = os.path.basename(filename)
+            return self.entries.key(f, VERSION, name, *options)
+
+    def fetch(self, key):
+        entry = self.entries.path(key)
+        try:
+            with open(entry, "r") as f:
+                text, routines, hasMain, mainFunc, probes, count = json.load(f)
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        return text, set(routines), hasMain, mainFunc, probes, count
+
+    def store(self, key, result):
+        text, routines, hasMain, mainFunc, probes, count = result
+        result = [text, sorted(routines), hasMain, mainFunc, probes, count]
+        with self.assembler.atomic_open(self.entries.path(key)) as f:
+            json.dump(result, f)
+
+    def evict(self):
+        self.entries.evict()
+
+
+def default_cache_dir():
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(root, "hack-translator")
+
+
+def translate_cached(filenames, writer, cache, jobs=None, keep=None, optimizer=None):
+    """Link the files into `writer` as translate_parallel() does, taking the
+    translation of every file whose content and options are unchanged from
+    `cache` and translating only the others, in a process pool when `jobs`
+    is more than one. Returns the number of commands linked and whether each
+    file was a cache hit."""
+    options = (
+        type(writer).__name__,
+        "compact" if writer.compact else "",
+        "" if keep is None else " ".join(sorted(keep)),
+        "" if optimizer is None else "optimize",
+    )
+    keys = [cache.key(x, *options) for x in filenames]
+    results = [cache.fetch(x) for x in keys]
+    hits = [x is not None for x in results]
+    missing = [i for i, hit in enumerate(hits) if not hit]
+    job = (type(writer), writer.compact, keep, optimizer)
+    work = [(filenames[i],) + job for i in missing]
+    if jobs and jobs > 1 and len(work) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            built = list(pool.map(_translate_job, work))
+    else:
+        built = [_translate_job(x) for x in work]
+    for i, result in zip(missing, built):
+        results[i] = result
+        cache.store(keys[i], result)
+    return link(writer, results), hits
+
+
 def main():
     argParser = argparse.ArgumentParser(description="A hack VM parser")
     argParser.add_argument("fin", help="input file (end with .vm) or folder")
+    argParser.add_argument(
+        "--compact",
+        action="store_true",
+        help="(optional) share one call, return and compare routine instead of "
+        "inlining them at every use, trading cycles for ROM",
+    )
+    argParser.add_argument(
+        "--stack-cache",
+        action="store_true",
+        help="(optional) keep the top of the stack in D within basic blocks",
+    )
+    argParser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="(optional) translate the files of a folder in this many parallel "
+        "processes; they are linked in file name order",
+    )
+    argParser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="(optional) reuse the translation of the files of a folder that "
+        "did not change since an earlier build, and report the cache hits",
+    )
+    argParser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="(optional) where translated files are cached for --incremental, "
+        "defaults to $XDG_CACHE_HOME/hack-translator",
+    )
+    argParser.add_argument(
+        "--prune",
+        action="store_true",
+        help="(optional) leave out the functions that cannot be called from "
+        "Sys.init, and report them",
+    )
+    argParser.add_argument(
+        "--inline",
+        type=int,
+        metavar="SIZE",
+        help="(optional) inline the functions of at most SIZE commands that "
+        "call nothing and do not branch into their callers; the whole program "
+        "is then translated in this process",
+    )
+    argParser.add_argument(
+        "-O",
+        "--optimize",
+        action="store_true",
+        help="(optional) fold constant arithmetic, double instead of calling "
+        "Math.multiply with a power of two and drop push/pop pairs of the "
+        "same location",
+    )
+    argParser.add_argument(
+        "-f",
+        "--format",
+        choices=("asm", "text", "binary"),
+        default="asm",
+        help="(optional) asm for assembly; text (.hack) or binary (.bin) to "
+        "encode the ROM directly, without going through assembly",
+    )
+    argParser.add_argument(
+        "--asm",
+        action="store_true",
+        help="(optional) with a ROM format, also write the assembly, for debugging",
+    )
+    argParser.add_argument(
+        "--profile",
+        action="store_true",
+        help="(optional) also write the .prof file profiler.py needs, and the "
+        ".sym file with a ROM format",
+    )
 
     args = argParser.parse_args()
     fin = args.fin
+    Writer = StackCacheWriter if args.stack_cache else CodeWriter
     if os.path.isfile(fin):
         inputFiles = [fin]
-        writer = CodeWriter(read_name(fin) + ".asm", False)
+        writer = Writer(read_name(fin) + ".asm", False, args.compact)
     else:
         inputFiles = list(filter(lambda x: read_extension(x) == "vm", os.listdir(fin)))
-        writer = CodeWriter(
+        writer = Writer(
             os.path.join(fin, os.path.split(fin)[0].split("/")[-1]) + ".asm",
             len(inputFiles) > 1,
+            args.compact,
         )
 
-    for filename in inputFiles:
-        print(filename)
-        with open(os.path.join(fin, filename), "r") as fd:
-            parser = Parser(fd)
-        writer.setFileName(read_name(os.path.basename(filename)))
+    optimizer = Optimizer() if args.optimize else None
+    paths = [os.path.join(fin, x) for x in inputFiles]
+    programs = None
+    if args.inline:
+        inliner = Inliner(args.inline)
+        programs = inliner.run([Program.from_file(x) for x in paths])
+        print(
+            "inlined {} calls of {} functions".format(
+                inliner.inlined, len(inliner.functions)
+            )
+        )
+    keep = None
+    if args.prune:
+        if programs is None:
+            programs = [Program.from_file(x) for x in paths]
+        keep = live_functions(programs, writer.multiple)
+        dead = set(call_graph(programs)) - keep
+        dropped = [x.select(dead) for x in programs]
+        saved = rom_size(dropped, paths, Writer, args.compact)
+        print("dropped {} functions, {} ROM words".format(len(dead), saved))
+        for name in sorted(dead):
+            print("  " + name)
 
-        while parser.hasMoreCommands():
-            parser.advance()
-            if parser.commandType() == "C_ARITHMETIC":
-                writer.writeArithmetic(parser.arg1())
-            if parser.commandType() == "C_POP":
-                writer.writePushPop("pop", parser.arg1(), parser.arg2())
-            if parser.commandType() == "C_PUSH":
-                writer.writePushPop("push", parser.arg1(), parser.arg2())
-            if parser.commandType() == "C_FUNCTION":
-                writer.writeFunc(parser.arg1(), parser.arg2())
-            if parser.commandType() == "C_CALL":
-                writer.writeCall(parser.arg1(), parser.arg2())
-            if parser.commandType() == "C_RETURN":
-                writer.writeReturn()
-            if parser.commandType() == "C_GOTO":
-                writer.writeGoto(parser.arg1())
-            if parser.commandType() == "C_IF":
-                writer.writeIf(parser.arg1())
-            if parser.commandType() == "C_LABEL":
-                writer.writeLabel(parser.arg1())
+    if args.inline:
+        for filename, program in zip(inputFiles, programs):
+            print(filename)
+            translate_program(program, writer, keep, optimizer)
+    elif args.incremental and writer.multiple:
+        inputFiles.sort()
+        cache = FragmentCache(args.cache_dir)
+        start = time.perf_counter()
+        _, hits = translate_cached(
+            [os.path.join(fin, x) for x in inputFiles],
+            writer,
+            cache,
+            args.jobs,
+            keep,
+            optimizer,
+        )
+        for filename, hit in zip(inputFiles, hits):
+            print(filename + (" (cached)" if hit else ""))
+        print(
+            "cache: {} hits, {} misses, linked in {:.1f} ms".format(
+                sum(hits),
+                len(hits) - sum(hits),
+                (time.perf_counter() - start) * 1000,
+            )
+        )
+        cache.evict()
+    elif args.jobs and writer.multiple:
+        inputFiles.sort()
+        for filename in inputFiles:
+            print(filename)
+        translate_parallel(
+            [os.path.join(fin, x) for x in inputFiles],
+            writer,
+            args.jobs,
+            keep,
+            optimizer,
+        )
+    else:
+        for filename in inputFiles:
+            print(filename)
+            translate(os.path.join(fin, filename), writer, keep, optimizer)
+    serial = args.inline or not (args.incremental or args.jobs)
+    if optimizer is not None and serial:
+        print(
+            "optimized: {} -> {} VM commands, {} multiplications "
+            "doubled".format(
+                optimizer.seen, optimizer.kept, optimizer.multiplications
+            )
+        )
 
     if writer.multiple: writer.writeMain()
+    if args.profile:
+        write_probes(writer)
+    if args.format == "asm":
+        writer.close()
+    else:
+        write_rom(writer, args.format, args.asm, args.profile)
 
 
 if __name__ == "__main__":
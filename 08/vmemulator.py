@@ -0,0 +1,638 @@
+import argparse
+import collections
+import glob
+import os
+import time
+
+import translator
+import vmparser
+
+# operations of the decoded program; push and pop are split by how their
+# address is found, labels are gone and jumps hold the index they go to
+(
+    PUSH_CONST,
+    PUSH_SEG,
+    PUSH_AT,
+    POP_SEG,
+    POP_AT,
+    ADD,
+    SUB,
+    NEG,
+    EQ,
+    GT,
+    LT,
+    AND,
+    OR,
+    NOT,
+    GOTO,
+    IF,
+    CALL,
+    FUNCTION,
+    RETURN,
+    HALT,
+    NATIVE,
+) = range(21)
+
+arithmetic = {
+    vmparser.ADD: ADD,
+    vmparser.SUB: SUB,
+    vmparser.NEG: NEG,
+    vmparser.EQ: EQ,
+    vmparser.GT: GT,
+    vmparser.LT: LT,
+    vmparser.AND: AND,
+    vmparser.OR: OR,
+    vmparser.NOT: NOT,
+}
+
+# segments reached through a pointer, by the RAM address of the pointer
+pointerSegment = {"local": 1, "argument": 2, "this": 3, "that": 4}
+# segments at fixed RAM addresses, by their base
+fixedSegment = {"pointer": 3, "temp": 5}
+
+VAR_BASE = 16
+
+
+def wrap(x):
+    # two's complement 16-bit view of an int
+    return ((x + 0x8000) & 0xFFFF) - 0x8000
+
+
+def less(x, y):
+    # lt as the Hack code computes it: on the sign of the 16-bit x - y
+    return wrap(x - y) < 0
+
+
+def greater(x, y):
+    return wrap(x - y) > 0
+
+
+class SysError(Exception):
+    # raised by a native OS function where the VM code calls Sys.error
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class NativeOS:
+    """Python versions of the functions of the OS classes Math, Memory and
+    String. They follow the compiled OS of the course step by step, down to
+    the 16-bit wraparound and the comparisons on the sign of a wrapped
+    difference (see less; against 0 or between small counters an exact
+    comparison is the same), the free list of Memory and the scratch array of
+    Math.divide, so the heap, the screen and every static end up as the VM
+    code would leave them; only the dead part of the stack above SP and the
+    scratch temp 0 can differ. Where the VM code calls Sys.error they raise
+    SysError, and the VM makes that call in their place. String.setInt is
+    left to the VM code."""
+
+    classes = ("Math", "Memory", "String")
+
+    def __init__(self, vm):
+        self.ram = vm.ram
+        self.static = vm.static
+        self.functions = {
+            "Math.abs": self.abs,
+            "Math.multiply": self.multiply,
+            "Math.divide": self.divide,
+            "Math.sqrt": self.sqrt,
+            "Math.max": self.max,
+            "Math.min": self.min,
+            "Memory.peek": self.peek,
+            "Memory.poke": self.poke,
+            "Memory.alloc": self.alloc,
+            "Memory.deAlloc": self.deAlloc,
+            "String.new": self.newString,
+            "String.dispose": self.dispose,
+            "String.length": self.length,
+            "String.charAt": self.charAt,
+            "String.setCharAt": self.setCharAt,
+            "String.appendChar": self.appendChar,
+            "String.eraseLastChar": self.eraseLastChar,
+            "String.intValue": self.intValue,
+            "String.newLine": lambda: 128,
+            "String.backSpace": lambda: 129,
+            "String.doubleQuote": lambda: 34,
+        }
+
+    def abs(self, x):
+        return wrap(-x) if x < 0 else x
+
+    def multiply(self, x, y):
+        # shift-and-add over the bits of the smaller operand comes to the
+        # product modulo 2^16 for every pair of operands
+        return wrap(x * y)
+
+    def divide(self, x, y):
+        # long division that keeps the doublings of y in Math's static 1
+        if y == 0:
+            raise SysError(3)
+        ram = self.ram
+        negative = (x < 0 and y > 0) or (x > 0 and y < 0)
+        twoToThe = ram[self.static("Math.0")]
+        doubles = ram[self.static("Math.1")]
+        ram[doubles] = self.abs(y)
+        x = self.abs(x)
+        j = 0
+        over = False
+        while j < 15 and not over:
+            d = wrap(ram[wrap(j + doubles)] - 1)
+            over = less(wrap(32767 - d), d)
+            if not over:
+                d = ram[wrap(j + doubles)]
+                ram[wrap(j + 1 + doubles)] = wrap(d + d)
+                over = greater(wrap(ram[wrap(j + 1 + doubles)] - 1), wrap(x - 1))
+                if not over:
+                    j += 1
+        q = 0
+        while j > -1:
+            if not greater(wrap(ram[wrap(j + doubles)] - 1), wrap(x - 1)):
+                q = wrap(q + ram[wrap(j + twoToThe)])
+                x = wrap(x - ram[wrap(j + doubles)])
+            j -= 1
+        return wrap(-q) if negative else q
+
+    def sqrt(self, x):
+        if x < 0:
+            raise SysError(4)
+        ram = self.ram
+        twoToThe = ram[self.static("Math.0")]
+        y = 0
+        for j in range(7, -1, -1):
+            t = wrap(y + ram[wrap(j + twoToThe)])
+            square = wrap(t * t)
+            if not greater(square, x) and square >= 0:
+                y = t
+        return y
+
+    def max(self, a, b):
+        return a if greater(a, b) else b
+
+    def min(self, a, b):
+        return a if less(a, b) else b
+
+    def peek(self, address):
+        return self.ram[wrap(address + self.ram[self.static("Memory.0")])]
+
+    def poke(self, address, value):
+        self.ram[wrap(address + self.ram[self.static("Memory.0")])] = value
+        return 0
+
+    def alloc(self, size):
+        # first fit over the free list from 2048: a segment holds its
+        # length and the next segment, and is split when there is room
+        if less(size, 1):
+            raise SysError(5)
+        ram = self.ram
+        block = 2048
+        for _ in range(0x8000):
+            if not less(ram[block], size):
+                break
+            block = ram[wrap(1 + block)]
+        else:
+            raise RuntimeError("the free list of Memory runs in circles")
+        if greater(wrap(block + size), 16379):
+            raise SysError(6)
+        if greater(ram[block], wrap(size + 2)):
+            rest = wrap(wrap(size + 2) + block)
+            ram[rest] = wrap(wrap(ram[block] - size) - 2)
+            if ram[wrap(1 + block)] == wrap(block + 2):
+                value = wrap(wrap(block + size) + 4)
+            else:
+                value = ram[wrap(1 + block)]
+            ram[wrap(wrap(size + 3) + block)] = value
+            ram[wrap(1 + block)] = rest
+        ram[block] = 0
+        return wrap(block + 2)
+
+    def deAlloc(self, o):
+        ram = self.ram
+        segment = wrap(o - 2)
+        after = ram[wrap(1 + segment)]
+        if ram[after] == 0:
+            ram[segment] = wrap(wrap(after - segment) - 2)
+        else:
+            ram[segment] = wrap(wrap(after - segment) + ram[after])
+            if ram[wrap(1 + after)] == wrap(after + 2):
+                ram[wrap(1 + segment)] = wrap(segment + 2)
+            else:
+                ram[wrap(1 + segment)] = ram[wrap(1 + after)]
+        return 0
+
+    # a String is 3 words: maximum length, the character array, the length
+
+    def newString(self, maxLength):
+        this = self.alloc(3)
+        if maxLength < 0:
+            raise SysError(14)
+        ram = self.ram
+        if maxLength > 0:
+            ram[this + 1] = self.alloc(maxLength)
+        ram[this] = maxLength
+        ram[this + 2] = 0
+        return this
+
+    def dispose(self, this):
+        if self.ram[this] > 0:
+            self.deAlloc(self.ram[this + 1])
+        self.deAlloc(this)
+        return 0
+
+    def length(self, this):
+        return self.ram[this + 2]
+
+    def _check(self, this, j, code):
+        if j < 0 or greater(j, self.ram[this + 2]) or j == self.ram[this + 2]:
+            raise SysError(code)
+        return wrap(j + self.ram[this + 1])
+
+    def charAt(self, this, j):
+        return self.ram[self._check(this, j, 15)]
+
+    def setCharAt(self, this, j, c):
+        self.ram[self._check(this, j, 16)] = c
+        return 0
+
+    def appendChar(self, this, c):
+        ram = self.ram
+        if ram[this + 2] == ram[this]:
+            raise SysError(17)
+        ram[wrap(ram[this + 2] + ram[this + 1])] = c
+        ram[this + 2] = wrap(ram[this + 2] + 1)
+        return this
+
+    def eraseLastChar(self, this):
+        ram = self.ram
+        if ram[this + 2] == 0:
+            raise SysError(18)
+        ram[this + 2] = wrap(ram[this + 2] - 1)
+        return 0
+
+    def intValue(self, this):
+        ram = self.ram
+        length = ram[this + 2]
+        chars = ram[this + 1]
+        if length == 0:
+            return 0
+        value = i = 0
+        negative = ram[chars] == 45
+        if negative:
+            i = 1
+        while less(i, length):
+            digit = wrap(ram[wrap(i + chars)] - 48)
+            if digit < 0 or greater(digit, 9):
+                break
+            value = wrap(wrap(value * 10) + digit)
+            i += 1
+        return wrap(-value) if negative else value
+
+
+class VM:
+    """Runs VM programs without translating them. The RAM is laid out as
+    the code of CodeWriter lays it out once assembled: SP, LCL, ARG, THIS
+    and THAT in RAM[0..4], temp at 5, the static variables from 16 in order
+    of first reference, the stack from 256 and call frames built the same
+    way, so a program sees (and a test checks) the same memory. The one
+    difference is the return address in a frame, which is the index of a
+    command rather than a ROM address.
+
+    Calls of the OS classes named in `natives` (see NativeOS) run Python
+    code instead of the VM code of the class.
+
+    Loading decodes every command once: segment names become addresses,
+    labels and function names become the index of the command they mark,
+    so running is a walk over tuples."""
+
+    def __init__(self, programs, filenames, bootstrap, natives=()):
+        self.ram = [0] * 0x8000
+        self.statics = {}
+        self.code = []
+        # the (file, line) every command of code was decoded from
+        self.positions = []
+        self.functions = {}
+        labels = {}
+        jumps = []
+        for program, filename in zip(programs, filenames):
+            self.decode(program, filename, labels, jumps)
+        # a call of a function that is defined nowhere fails at load time
+        for i, target in jumps:
+            op, _, b = self.code[i]
+            table = self.functions if op == CALL else labels
+            if target not in table:
+                kind = "function" if op == CALL else "label"
+                raise NameError(
+                    "{}: undefined {} {}".format(self.where(i), kind, target)
+                )
+            self.code[i] = (op, table[target], b)
+        self.native(natives, jumps)
+        self.halt = len(self.code)
+        self.code.append((HALT, 0, 0))
+        self.pc = 0
+        self.steps = 0
+        self.bootstrap = bootstrap
+        if bootstrap:
+            self.boot()
+
+    @classmethod
+    def from_path(cls, path, natives=()):
+        # a .vm file, or a folder whose files are one program; a folder of
+        # more than one file gets the bootstrap, as with the translator
+        if os.path.isdir(path):
+            filenames = sorted(glob.glob(os.path.join(path, "*.vm")))
+        else:
+            filenames = [path]
+        programs = [vmparser.Program.from_file(x) for x in filenames]
+        return cls(programs, filenames, len(filenames) > 1, natives)
+
+    def static(self, name):
+        address = self.statics.get(name)
+        if address is None:
+            address = self.statics[name] = VAR_BASE + len(self.statics)
+        return address
+
+    def decode(self, program, filename, labels, jumps):
+        code = self.code
+        append = code.append
+        prefix = translator.read_name(os.path.basename(filename)) + "."
+        function = ""
+        positions = self.positions
+        for (op, name, value), line in zip(program, program.positions):
+            if op == vmparser.PUSH or op == vmparser.POP:
+                push = op == vmparser.PUSH
+                if name == "constant":
+                    append((PUSH_CONST, value, 0))
+                elif name in pointerSegment:
+                    segment = pointerSegment[name]
+                    append((PUSH_SEG if push else POP_SEG, segment, value))
+                else:
+                    if name == "static":
+                        address = self.static(prefix + str(value))
+                    elif name.startswith("static."):
+                        address = self.static(name[7:] + "." + str(value))
+                    else:
+                        address = fixedSegment[name] + value
+                    append((PUSH_AT if push else POP_AT, address, 0))
+            elif op in arithmetic:
+                append((arithmetic[op], 0, 0))
+            elif op == vmparser.LABEL:
+                labels[function + "$" + name] = len(code)
+            elif op == vmparser.GOTO or op == vmparser.IF:
+                jumps.append((len(code), function + "$" + name))
+                append((GOTO if op == vmparser.GOTO else IF, None, 0))
+            elif op == vmparser.FUNCTION:
+                function = name
+                self.functions[name] = len(code)
+                append((FUNCTION, value, 0))
+            elif op == vmparser.CALL:
+                jumps.append((len(code), name))
+                append((CALL, None, value))
+            else:
+                append((RETURN, 0, 0))
+            if len(positions) < len(code):
+                positions.append((filename, line))
+
+    def native(self, classes, jumps):
+        if not classes:
+            return
+        unknown = set(classes) - set(NativeOS.classes)
+        if unknown:
+            raise ValueError("no native version of " + ", ".join(sorted(unknown)))
+        functions = NativeOS(self).functions
+        self.sysError = self.functions.get("Sys.error")
+        for i, target in jumps:
+            op, a, b = self.code[i]
+            if op == CALL and target in functions and target.split(".")[0] in classes:
+                self.code[i] = (NATIVE, (functions[target], a), b)
+
+    def where(self, pc):
+        # the .vm line of a command, as file:line
+        if pc < len(self.positions):
+            return "{}:{}".format(*self.positions[pc])
+        return "(bootstrap)"
+
+    def boot(self):
+        # what writeInit does: SP=256 and a call of Sys.init; without one,
+        # writeMain's stand-in that calls the last function defined
+        if "Sys.init" not in self.functions:
+            main = max(self.functions.items(), key=lambda x: x[1])[0]
+            stub = self.functions["Sys.init"] = len(self.code)
+            self.code.append((CALL, self.functions[main], 0))
+            self.code.append((GOTO, stub + 1, 0))
+        ram = self.ram
+        ram[0] = 261
+        ram[256] = self.halt
+        ram[257:261] = ram[1:5]
+        ram[2] = 256
+        ram[1] = 261
+        self.pc = self.functions["Sys.init"]
+
+    def run(self, steps):
+        """Execute up to `steps` commands; stops early when the program halts,
+        i.e. runs out of commands, returns to where there is no command or
+        reaches a goto to itself. Returns the number executed."""
+        code = self.code
+        ram = self.ram
+        halt = self.halt
+        pc = self.pc
+        sp = ram[0]
+        n = 0
+        while n < steps:
+            op, a, b = code[pc]
+            n += 1
+            pc += 1
+            if op == PUSH_CONST:
+                ram[sp] = a
+                sp += 1
+            elif op == PUSH_SEG:
+                ram[sp] = ram[ram[a] + b]
+                sp += 1
+            elif op == PUSH_AT:
+                ram[sp] = ram[a]
+                sp += 1
+            elif op == POP_SEG:
+                sp -= 1
+                ram[ram[a] + b] = ram[sp]
+            elif op == POP_AT:
+                sp -= 1
+                ram[a] = ram[sp]
+            elif op == ADD:
+                sp -= 1
+                x = ram[sp - 1] + ram[sp]
+                if x > 32767:
+                    x -= 65536
+                elif x < -32768:
+                    x += 65536
+                ram[sp - 1] = x
+            elif op == SUB:
+                sp -= 1
+                x = ram[sp - 1] - ram[sp]
+                if x > 32767:
+                    x -= 65536
+                elif x < -32768:
+                    x += 65536
+                ram[sp - 1] = x
+            elif op == IF:
+                sp -= 1
+                if ram[sp]:
+                    pc = a
+            elif op == GOTO:
+                if a == pc - 1:
+                    pc -= 1
+                    break
+                pc = a
+            elif op == LT:
+                # the sign of the 16-bit x - y, as the translated code tests
+                sp -= 1
+                x = ram[sp - 1] - ram[sp]
+                if x > 32767:
+                    x -= 65536
+                elif x < -32768:
+                    x += 65536
+                ram[sp - 1] = -1 if x < 0 else 0
+            elif op == GT:
+                sp -= 1
+                x = ram[sp - 1] - ram[sp]
+                if x > 32767:
+                    x -= 65536
+                elif x < -32768:
+                    x += 65536
+                ram[sp - 1] = -1 if x > 0 else 0
+            elif op == EQ:
+                sp -= 1
+                ram[sp - 1] = -1 if ram[sp - 1] == ram[sp] else 0
+            elif op == AND:
+                sp -= 1
+                ram[sp - 1] &= ram[sp]
+            elif op == OR:
+                sp -= 1
+                ram[sp - 1] |= ram[sp]
+            elif op == NOT:
+                ram[sp - 1] = ~ram[sp - 1]
+            elif op == NEG:
+                x = -ram[sp - 1]
+                ram[sp - 1] = -32768 if x == 32768 else x
+            elif op == CALL or op == NATIVE:
+                if op == NATIVE:
+                    func, a = a
+                    try:
+                        ram[sp - b] = func(*ram[sp - b : sp])
+                        sp -= b - 1
+                        continue
+                    except SysError as error:
+                        # call Sys.error where the VM code would have
+                        sp -= b - 1
+                        ram[sp - 1] = error.code
+                        a = self.sysError
+                        b = 1
+                # the frame of writeCall: return address, LCL, ARG, THIS, THAT
+                ram[sp] = pc
+                ram[sp + 1] = ram[1]
+                ram[sp + 2] = ram[2]
+                ram[sp + 3] = ram[3]
+                ram[sp + 4] = ram[4]
+                sp += 5
+                ram[2] = sp - b - 5
+                ram[1] = sp
+                pc = a
+            elif op == FUNCTION:
+                for _ in range(a):
+                    ram[sp] = 0
+                    sp += 1
+            elif op == RETURN:
+                frame = ram[1]
+                pc = ram[frame - 5]
+                if not 0 <= pc < halt:
+                    # e.g. a test that calls a function on a made-up frame
+                    pc = halt
+                ram[ram[2]] = ram[sp - 1]
+                sp = ram[2] + 1
+                ram[4] = ram[frame - 1]
+                ram[3] = ram[frame - 2]
+                ram[2] = ram[frame - 3]
+                ram[1] = ram[frame - 4]
+            else:
+                pc -= 1
+                n -= 1
+                break
+        ram[0] = sp
+        self.pc = pc
+        self.steps += n
+        return n
+
+    @property
+    def halted(self):
+        op, a, _ = self.code[self.pc]
+        return op == HALT or (op == GOTO and a == self.pc)
+
+    def hot_lines(self, steps):
+        """Run up to `steps` commands one at a time, counting them by the .vm
+        line they come from; much slower than run(), for finding where the
+        time goes. Returns (file:line, commands) pairs, most run first."""
+        counts = collections.Counter()
+        n = 0
+        while n < steps and not self.halted:
+            pc = self.pc
+            if not self.run(1):
+                break
+            counts[pc] += 1
+            n += 1
+        lines = collections.Counter()
+        for pc, count in counts.items():
+            lines[self.where(pc)] += count
+        return lines.most_common()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run VM programs directly")
+    parser.add_argument("fin", help="a .vm file, or a folder of them")
+    parser.add_argument(
+        "-n",
+        "--steps",
+        type=int,
+        default=10_000_000,
+        help="(optional) number of VM commands to execute",
+    )
+    parser.add_argument(
+        "--dump",
+        default="",
+        help="(optional) comma separated RAM addresses to print afterwards",
+    )
+    parser.add_argument(
+        "--native",
+        default="",
+        help="(optional) comma separated OS classes to run as Python code: "
+        + ", ".join(NativeOS.classes),
+    )
+    parser.add_argument(
+        "--hot",
+        type=int,
+        metavar="N",
+        help="(optional) run one command at a time and list the N .vm lines "
+        "that ran the most commands",
+    )
+    args = parser.parse_args()
+
+    vm = VM.from_path(args.fin, tuple(filter(None, args.native.split(","))))
+    if args.hot:
+        lines = vm.hot_lines(args.steps)
+        total = sum(count for _, count in lines)
+        for where, count in lines[: args.hot]:
+            print("{:>10} {:6.2f}%  {}".format(count, 100 * count / total, where))
+        return
+    start = time.perf_counter()
+    n = vm.run(args.steps)
+    elapsed = time.perf_counter() - start
+    print(
+        "{} commands in {:.3f} s, {:.2f} M commands/s{}".format(
+            n,
+            elapsed,
+            n / elapsed / 1e6 if elapsed else 0,
+            ", halted" if vm.halted else "",
+        )
+    )
+    for address in filter(None, args.dump.split(",")):
+        print("RAM[{}] = {}".format(address, vm.ram[int(address)]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+from array import array
+
+# opcodes of the VM intermediate representation; the order groups them so
+# that ranges can be tested: memory access, arithmetic, then flow
+(
+    PUSH,
+    POP,
+    ADD,
+    SUB,
+    NEG,
+    EQ,
+    GT,
+    LT,
+    AND,
+    OR,
+    NOT,
+    LABEL,
+    GOTO,
+    IF,
+    FUNCTION,
+    CALL,
+    RETURN,
+) = range(17)
+
+opcodeNames = (
+    "push",
+    "pop",
+    "add",
+    "sub",
+    "neg",
+    "eq",
+    "gt",
+    "lt",
+    "and",
+    "or",
+    "not",
+    "label",
+    "goto",
+    "if-goto",
+    "function",
+    "call",
+    "return",
+)
+opcodeTable = {name: op for op, name in enumerate(opcodeNames)}
+
+# number of operands every opcode takes
+arity = bytes([2, 2] + [0] * 9 + [1, 1, 1, 2, 2, 0])
+
+# highest index of every segment; static.File, which the Inliner writes for
+# the statics of another file, is internal and not accepted from source text
+segmentLimit = {
+    "constant": 0x7FFF,
+    "local": 0x7FFF,
+    "argument": 0x7FFF,
+    "this": 0x7FFF,
+    "that": 0x7FFF,
+    "static": 0x7FFF,
+    "pointer": 1,
+    "temp": 7,
+}
+
+
+class Program:
+    """A parsed VM file as parallel arrays: the opcode of every command, the
+    index of its name operand (segment, label or function) in `names`, its
+    int operand (index, number of locals or arguments) and the line of the
+    file it was read from. Names are interned, so a label used a hundred
+    times is stored once. Commands without an operand store 0 in its place.
+
+    Every line is split once, and its command and operands are checked as it
+    is read; a malformed command raises SyntaxError with the file name and
+    line number, so nothing downstream has to validate again."""
+
+    __slots__ = (
+        "ops",
+        "args",
+        "values",
+        "positions",
+        "names",
+        "nameIndex",
+        "filename",
+    )
+
+    def __init__(self, filename=None):
+        self.ops = array("B")
+        self.args = array("H")
+        self.values = array("i")
+        self.positions = array("I")
+        self.names = [""]
+        self.nameIndex = {"": 0}
+        self.filename = filename
+
+    @classmethod
+    def from_file(cls, filename):
+        program = cls(filename)
+        with open(filename, "r") as fd:
+            program.parse(fd)
+        return program
+
+    def intern(self, name):
+        index = self.nameIndex.get(name)
+        if index is None:
+            index = self.nameIndex[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def append(self, op, name="", value=0, line=0):
+        self.ops.append(op)
+        self.args.append(self.intern(name))
+        self.values.append(value)
+        self.positions.append(line)
+
+    def error(self, message, lineno, line):
+        return SyntaxError(message, (self.filename, lineno, 1, line.strip()))
+
+    def parse(self, lines):
+        # append() inlined: this loop is the whole cost of parsing
+        ops = self.ops.append
+        args = self.args.append
+        values = self.values.append
+        positions = self.positions.append
+        names = self.names
+        nameIndex = self.nameIndex
+        for lineno, line in enumerate(lines, 1):
+            i = line.find("//")
+            words = (line if i == -1 else line[:i]).split()
+            if not words:
+                continue
+            op = opcodeTable.get(words[0])
+            if op is None:
+                raise self.error("unknown command " + words[0], lineno, line)
+            if len(words) != arity[op] + 1:
+                raise self.error(
+                    "{} takes {} operands".format(words[0], arity[op]), lineno, line
+                )
+            ops(op)
+            positions(lineno)
+            if len(words) == 1:
+                args(0)
+                values(0)
+                continue
+            name = words[1]
+            index = nameIndex.get(name)
+            if index is None:
+                index = nameIndex[name] = len(names)
+                names.append(name)
+            args(index)
+            if len(words) == 2:
+                values(0)
+                continue
+            if not words[2].isdigit():
+                raise self.error("not a number: " + words[2], lineno, line)
+            value = int(words[2])
+            if op <= POP:
+                limit = segmentLimit.get(name)
+                if limit is None:
+                    raise self.error("unknown segment " + name, lineno, line)
+                if value > limit:
+                    raise self.error(
+                        "{} {} is out of range".format(name, value), lineno, line
+                    )
+                if op == POP and name == "constant":
+                    raise self.error("cannot pop to constant", lineno, line)
+            values(value)
+        return self
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        # (opcode, name, value) of every command
+        names = self.names
+        for op, arg, value in zip(self.ops, self.args, self.values):
+            yield op, names[arg], value
+
+    def __getitem__(self, i):
+        return self.ops[i], self.names[self.args[i]], self.values[i]
+
+    def position(self, i):
+        # where command i comes from, as file:line
+        return "{}:{}".format(self.filename, self.positions[i])
+
+    def select(self, keep):
+        # a copy with only the functions named in `keep`; "" stands for the
+        # commands before the first function
+        program = Program(self.filename)
+        current = ""
+        for (op, name, value), line in zip(self, self.positions):
+            if op == FUNCTION:
+                current = name
+            if current in keep:
+                program.append(op, name, value, line)
+        return program
+
+    def lines(self):
+        # the commands back as VM source
+        for op, name, value in self:
+            if op <= POP or op == FUNCTION or op == CALL:
+                yield "{} {} {}".format(opcodeNames[op], name, value)
+            elif op == LABEL or op == GOTO or op == IF:
+                yield "{} {}".format(opcodeNames[op], name)
+            else:
+                yield opcodeNames[op]
@@ -0,0 +1,57 @@
+import argparse
+import glob
+import os
+import time
+
+from JackCompiler import JackTokenizer, ScanningTokenizer
+
+
+def tokens(tokenizer, filename):
+    # every token of a file, as the compilation engine pulls them
+    tok = tokenizer(filename)
+    result = []
+    while tok.hasMoreTokens():
+        result.append(tok.advance())
+    return result
+
+
+def measure(tokenizer, files, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = [tokens(tokenizer, x) for x in files]
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the Jack tokenizers")
+    parser.add_argument(
+        "root",
+        nargs="?",
+        default=os.path.join(here, ".."),
+        help="(optional) the folder whose .jack files, at any depth, are "
+        "tokenized; the whole repository by default",
+    )
+    parser.add_argument("-n", type=int, default=5, help="repetitions, best is kept")
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.root, "**", "*.jack"), recursive=True))
+    char_time, char = measure(JackTokenizer, files, args.n)
+    scan_time, scan = measure(ScanningTokenizer, files, args.n)
+    for filename, a, b in zip(files, char, scan):
+        if [(x.typ, x.value) for x in a] != [(x.typ, x.value) for x in b]:
+            raise AssertionError("the tokenizers differ on " + filename)
+
+    count = sum(len(x) for x in scan)
+    print("{} files, {} tokens".format(len(files), count))
+    print("char    {:10.0f} tokens/s".format(count / char_time))
+    print("scan    {:10.0f} tokens/s".format(count / scan_time))
+    print("speedup {:10.2f}x".format(char_time / scan_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import re
 import argparse
 
 class Token:
@@ -189,6 +190,82 @@ class JackTokenizer:
     def close(self):
         close(self.file)
 
+
+class ScanningTokenizer:
+    """JackTokenizer that reads the whole file at once and cuts it into
+    tokens with one compiled pattern, instead of pulling it a character at
+    a time through FileReader. The tokens are the same, but every position
+    is the (line, column) where the token starts, the column counted from 0
+    as in FileReader.position."""
+
+    # one alternative per kind of token, tried in order at every position;
+    # the two last ones only match what the others left unfinished
+    pattern = re.compile(
+        r"""
+        (?P<skip>(?:\s+|//[^\n]*|/\*.*?\*/)+)
+        | (?P<INT_CONST>\d+)
+        | (?P<STRING_CONST>"[^"\n]*")
+        | (?P<IDENTIFIER>[^\W\d]\w*)
+        | (?P<unterminated>"|/\*)
+        | (?P<SYMBOL>.)
+        """,
+        re.VERBOSE | re.DOTALL,
+    )
+
+    def __init__(self, filename):
+        with open(filename, "r") as f:
+            text = f.read()
+        # kept reversed, so that advance() pops and feedback() pushes back
+        self.temp = list(ScanningTokenizer.scan(text, filename))[::-1]
+
+    @staticmethod
+    def scan(text, filename=None):
+        reserved = JackTokenizer.reserved
+        line = 1
+        lineStart = 0
+        for match in ScanningTokenizer.pattern.finditer(text):
+            typ = match.lastgroup
+            start = match.start()
+            if typ == "skip":
+                end = match.end()
+                newlines = text.count("\n", start, end)
+                if newlines:
+                    line += newlines
+                    lineStart = text.rindex("\n", start, end) + 1
+                continue
+            value = match.group()
+            pos = (line, start - lineStart)
+            if typ == "IDENTIFIER":
+                if value in reserved:
+                    typ = "KEYWORD"
+            elif typ == "INT_CONST":
+                value = int(value)
+            elif typ == "STRING_CONST":
+                value = value[1:-1]
+            elif typ == "unterminated":
+                what = "string" if value == '"' else "comment"
+                raise SyntaxError(
+                    "unterminated " + what,
+                    (filename, line, start - lineStart + 1, text[lineStart:start]),
+                )
+            yield Token(typ, value, pos)
+
+    def hasMoreTokens(self):
+        return len(self.temp) > 0
+
+    def advance(self):
+        return self.temp.pop()
+
+    def viewNext(self):
+        return self.temp[-1]
+
+    def feedback(self, x):
+        self.temp.append(x)
+
+    def close(self):
+        pass
+
+
 class SymbolTable:
     def __init__(self):
         self.table={"static":{}, "field":{}, "arg":{}, "var": {}}
@@ -254,8 +331,8 @@ class VMWriter:
         self.file.close()
 
 class CompilationEngine:
-    def __init__(self, infile, outfile):
-        self.tokenizer = JackTokenizer(infile)
+    def __init__(self, infile, outfile, tokenizer=ScanningTokenizer):
+        self.tokenizer = tokenizer(infile)
         self.writer = VMWriter(outfile)
         self.classVarList = set()
         self.subroutineVarList = set()